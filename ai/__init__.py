@@ -0,0 +1,3 @@
+DEFAULT_LABEL = "known"
+# face_recognition encodes faces with dlib ResNet model, stored in gallery files
+MODEL_VERSION = "dlib_face_recognition_resnet_model_v1"
@@ -1,14 +1,25 @@
 """Handle face recognizing"""
+import hashlib
 import os
 import logging
+from collections.abc import Iterator
 from pathlib import Path, PosixPath, WindowsPath
+import cv2
 import face_recognition
 import numpy as np
 
 import utils as u
+from ai import DEFAULT_LABEL, MODEL_VERSION
 
 logger = logging.getLogger()
 
+
+@u.timed
+def encode_faces(frame: np.ndarray, face_locations: list[tuple[int, int, int, int]]) -> list[np.ndarray]:
+    """Compute encodings of the faces at face_locations in frame"""
+    return face_recognition.face_encodings(frame, face_locations)
+
+
 class NoKnownFaceEncodingsError(Exception):
     """Exception raised when no known face encodings are provided."""
     def __init__(self, message="No known face encodings were provided."):
@@ -19,46 +30,151 @@ class NoKnownFaceEncodingsError(Exception):
 class FaceDetector():
     """Class that handles face recognition"""
 
-    def __init__(self, known_faces: list[np.ndarray] = []):
-        self.known_faces = known_faces
+    def __init__(
+            self,
+            known_faces: list[np.ndarray] | None = None,
+            known_labels: list[str] | None = None,
+            tolerance: float = 0.6,
+            scale: float = 1.0,
+            early_exit: bool = False,
+            min_face_size: int = 0,
+            region: tuple[int, int, int, int] | None = None
+        ):
+        if not 0 < scale <= 1:
+            raise ValueError(f"Detection scale must be in (0, 1] - found: {scale}")
+        self.scale = scale
+        self.region = region
+        self.early_exit = early_exit
+        self.min_face_size = min_face_size
+        self.known_faces = np.empty((0, 128))
+        self.known_labels = np.empty(0, dtype=u.GALLERY_RECORD["label"])
+        self.known_sources = np.empty(0, dtype=u.GALLERY_RECORD["source_hash"])
+        self.tolerance = tolerance
+        self._identities = None
+        if known_faces is not None:
+            known_faces = np.asarray(known_faces).reshape(-1, 128)
+            if known_labels is None:
+                known_labels = [DEFAULT_LABEL] * len(known_faces)
+            self._add_encodings(known_faces, known_labels, [""] * len(known_faces))
 
-    def train_from_encodings(self, face_encodings: list[np.ndarray]) -> None:
-        """add provided faces encoding to known face encodings"""
-        self.known_faces.append(face_encodings)
-        logger.info(f"Added {len(face_encodings)} encodings to model")
+    def _add_encodings(
+            self,
+            face_encodings: np.ndarray,
+            labels: list[str] | np.ndarray,
+            sources: list[str] | np.ndarray
+        ) -> None:
+        """append encodings, with their labels and source image hashes, to known faces"""
+        if not isinstance(labels, np.ndarray):
+            labels = np.array([u.to_gallery_bytes(label, "label") for label in labels], dtype=self.known_labels.dtype)
+        if not isinstance(sources, np.ndarray):
+            sources = np.array(
+                [u.to_gallery_bytes(source, "source_hash") for source in sources], dtype=self.known_sources.dtype
+            )
+        if len(self.known_faces) == 0:
+            # adopt arrays as they are, so that memory-mapped galleries are not copied
+            self.known_faces, self.known_labels, self.known_sources = face_encodings, labels, sources
+        else:
+            self.known_faces = np.concatenate([self.known_faces, face_encodings])
+            self.known_labels = np.concatenate([self.known_labels, labels])
+            self.known_sources = np.concatenate([self.known_sources, sources])
+        self._identities = None
 
-    def train_from_images(self, faces_dir: Path) -> None:
+    def train_from_encodings(self, face_encodings: list[np.ndarray], label: str = DEFAULT_LABEL) -> None:
+        """add provided faces encoding to known face encodings, all tagged with the same label"""
+        face_encodings = np.asarray(face_encodings, dtype=np.float64).reshape(-1, 128)
+        self._add_encodings(face_encodings, [label] * len(face_encodings), [""] * len(face_encodings))
+        logger.info(f"Added {len(face_encodings)} encodings labelled '{label}' to model")
+
+    def train_from_labelled_encodings(self, labelled_encodings: dict[str, np.ndarray]) -> None:
+        """add provided faces encodings to known face encodings, one entry per identity"""
+        for label, face_encodings in labelled_encodings.items():
+            self.train_from_encodings(face_encodings, label=label)
+
+    def train_from_gallery(self, gallery: u.Gallery) -> None:
+        """add encodings of a memory-mapped gallery to known face encodings"""
+        if gallery.model_version != MODEL_VERSION:
+            logger.warning(f"Gallery was built with model {gallery.model_version}, current model is {MODEL_VERSION}")
+        self._add_encodings(gallery.encodings, gallery.labels, gallery.source_hashes)
+        logger.info(f"Added {len(gallery)} gallery encodings to model")
+
+    def train_from_images(self, faces_dir: Path, label: str = DEFAULT_LABEL, skip_sources: set[str] = frozenset()) -> None:
         """
-        Extract face encodings from images directory and add to known face encodings
+        Extract face encodings from images directory and add to known face encodings.
+        Every subdirectory of faces_dir is treated as a separate identity named after it,
+        images placed directly in faces_dir are tagged with label.
         
         Args:
             faces_dir (Path): directory with training images
+            label (str): identity of the images placed directly in faces_dir
+            skip_sources (set[str]): hashes of images already encoded, which are skipped
         """
         logger.info(f"Extracting encodings from {faces_dir}")
         init_encodings = len(self.known_faces)
         if not faces_dir.is_dir():
             raise NotADirectoryError(f"path {faces_dir} is not a directory")
+        # check the label fits before encoding images
+        u.to_gallery_bytes(label, "label")
 
+        face_encodings, sources = [], []
         # Loop through each image file in the specified directory
-        for filename in os.listdir(faces_dir):
+        for filename in sorted(os.listdir(faces_dir)):
             # Load the image file
             image_path = Path(os.path.join(faces_dir, filename))
-            
+
+            if image_path.is_dir():
+                self.train_from_images(image_path, label=filename, skip_sources=skip_sources)
+                continue
+
             if not u.is_image_file(image_path):
                 continue
+
+            source = u.hash_file(image_path)
+            if source in skip_sources:
+                continue
             
             image = face_recognition.load_image_file(image_path)
             encodings = face_recognition.face_encodings(image)
 
-            if encodings:
-                self.known_faces.append(encodings)
+            face_encodings.extend(encodings)
+            sources.extend([source] * len(encodings))
+
+        if face_encodings:
+            self._add_encodings(np.asarray(face_encodings), [label] * len(face_encodings), sources)
             
         logger.info(f"Extracted {len(self.known_faces) - init_encodings} encodings from {faces_dir}")
 
-    def get_known_faces(self):
+    def get_known_faces(self) -> np.ndarray:
         """Returns known face encodings"""
         return self.known_faces
 
+    def get_known_labels(self) -> list[str]:
+        """Returns the identity label of each known face encoding"""
+        return [label.decode() for label in self.known_labels]
+
+    def get_known_sources(self) -> list[str]:
+        """Returns the source image hash of each known face encoding, empty if unknown"""
+        return [source.decode() for source in self.known_sources]
+
+    def get_fingerprint(self) -> str:
+        """Returns sha256 hex digest of known face encodings and labels, to check two detectors know the same faces"""
+        digest = hashlib.sha256(np.ascontiguousarray(self.known_faces, dtype=np.float32).tobytes())
+        digest.update(np.ascontiguousarray(self.known_labels).tobytes())
+        return digest.hexdigest()
+
+    def get_identities(self) -> list[str]:
+        """Returns the distinct identity labels of known face encodings"""
+        if self._identities is None:
+            self._identities = [label.decode() for label in np.unique(self.known_labels)]
+        return self._identities
+
+    def get_labelled_faces(self) -> dict[str, np.ndarray]:
+        """Returns known face encodings grouped by identity"""
+        return {
+            label: self.known_faces[self.known_labels == label.encode()]
+            for label in self.get_identities()
+        }
+
+    @u.timed
     def detect_faces(self, frame: np.ndarray):
         """
         Detect face locations and encodings in the current frame
@@ -68,11 +184,88 @@ class FaceDetector():
         Returns:
             face_encodings (list[np.ndarray]): list of detected face encodings
         """
-        face_locations = face_recognition.face_locations(frame)
-        face_encodings = face_recognition.face_encodings(frame, face_locations)
+        face_locations = self.locate_faces(frame)
+        face_encodings = encode_faces(frame, face_locations)
 
         return face_encodings
 
+    @u.timed
+    def locate_faces(self, frame: np.ndarray) -> list[tuple[int, int, int, int]]:
+        """
+        Detect face locations in the current frame. Detection runs on self.region of the frame,
+        resized by self.scale, and boxes are mapped back to the original frame coordinates.
+        Faces smaller than self.min_face_size pixels are skipped, and the others are sorted
+        from largest to smallest
+
+        Args:
+            frame (np.ndarray): frame to analyze stored in np.ndarray
+        Returns:
+            list[tuple[int, int, int, int]]: (top, right, bottom, left) face boxes
+        """
+        offset_top, offset_left = 0, 0
+        if self.region is not None:
+            offset_top, right, bottom, offset_left = self.region
+            # dlib needs a contiguous image
+            frame = np.ascontiguousarray(frame[offset_top:bottom, offset_left:right])
+
+        if self.scale == 1:
+            face_locations = face_recognition.face_locations(frame)
+        else:
+            small_frame = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            height, width = frame.shape[:2]
+            face_locations = [
+                (
+                    max(int(top / self.scale), 0),
+                    min(int(right / self.scale), width),
+                    min(int(bottom / self.scale), height),
+                    max(int(left / self.scale), 0),
+                )
+                for top, right, bottom, left in face_recognition.face_locations(small_frame)
+            ]
+
+        face_locations = [
+            (top + offset_top, right + offset_left, bottom + offset_top, left + offset_left)
+            for top, right, bottom, left in face_locations
+        ]
+
+        face_locations = [
+            (top, right, bottom, left)
+            for top, right, bottom, left in face_locations
+            if min(bottom - top, right - left) >= self.min_face_size
+        ]
+        face_locations.sort(key=lambda box: (box[2] - box[0]) * (box[1] - box[3]), reverse=True)
+        return face_locations
+
+    @u.timed
+    def frame_labels(self, frame: np.ndarray, stop_at_first_match: bool = False) -> set[str]:
+        """
+        Identify known faces in the current frame.
+
+        With self.early_exit, faces are encoded lazily from largest to smallest, and encoding stops
+        at the first match if stop_at_first_match, or once every known identity matched otherwise.
+        Without it, all faces are encoded in a single call.
+
+        Args:
+            frame (np.ndarray): frame to analyze stored in np.ndarray
+            stop_at_first_match (bool): with early exit, stop as soon as any identity matched
+        Returns:
+            set[str]: identities detected in the frame
+        """
+        face_locations = self.locate_faces(frame)
+        if not self.early_exit:
+            face_encodings = encode_faces(frame, face_locations)
+            return set().union(*(self.matched_labels(face_encoding) for face_encoding in face_encodings))
+
+        labels = set()
+        identities_count = len(self.get_identities())
+        for face_location in face_locations:
+            face_encoding = encode_faces(frame, [face_location])[0]
+            labels |= self.matched_labels(face_encoding)
+            if labels and (stop_at_first_match or len(labels) == identities_count):
+                break
+        return labels
+
+    @u.timed
     def known_face_detected(self, detected_face_encoding: np.ndarray) -> bool:
         """
         Compare known face encodings to a single face encoding detected in a frame
@@ -82,43 +275,102 @@ class FaceDetector():
         Returns:
             bool: True iff any known face matched with detected face encoding
         """
-        if not self.known_faces:
+        return len(self.matched_labels(detected_face_encoding)) > 0
+
+    @u.timed
+    def matched_labels(self, detected_face_encoding: np.ndarray) -> set[str]:
+        """
+        Compare known face encodings to a single face encoding detected in a frame
+
+        Args:
+            detected_face_encoding (np.ndarray): face encoding to compare
+        Returns:
+            set[str]: identities whose known encodings matched with detected face encoding
+        """
+        if len(self.known_faces) == 0:
             raise NoKnownFaceEncodingsError()
 
-        matches = face_recognition.compare_faces(self.known_faces, detected_face_encoding)
-        
-        for match in matches:
-            if np.any(match):
-                return True
-        return False
+        distances = face_recognition.face_distance(self.known_faces, detected_face_encoding)
+        return {label.decode() for label in set(self.known_labels[distances <= self.tolerance])}
+
+    def get_identity_timestamps(
+            self,
+            frame_list: list[np.ndarray],
+            frame_interval: int,
+            start_index: int = 0,
+            stop_at_first_match: bool = False
+        ) -> dict[str, set[int]]:
+        """
+        Iterate once through frames and save, for every known identity, frames where it is detected
+
+        Args:
+            frame_list (list[np.ndarray]): List of frames (NumPy arrays) extracted from the video.
+            frame_interval (int): frames interval to process
+            start_index (int): index of the first frame of frame_list in the whole video
+            stop_at_first_match (bool): with early exit, record only the first identity matched in a frame
+
+        Returns:
+            dict[str, set[int]]: timestamps (frame indices) where each identity was detected.
+        """
+        logger.info("Extracting timestamps per identity")
+        timestamps = {label: set() for label in self.get_identities()}
+        for frame_index, labels in self.iter_frame_labels(frame_list, frame_interval, start_index, stop_at_first_match):
+            for label in labels:
+                timestamps[label].add(frame_index)
+
+        return timestamps
+
+    def iter_frame_labels(
+            self,
+            frame_list: list[np.ndarray],
+            frame_interval: int,
+            start_index: int = 0,
+            stop_at_first_match: bool = False
+        ) -> Iterator[tuple[int, set[str]]]:
+        """
+        Iterate through frames and yield identities detected in each processed frame, as soon as it is processed
+
+        Args:
+            frame_list (list[np.ndarray]): List of frames (NumPy arrays) extracted from the video.
+            frame_interval (int): frames interval to process
+            start_index (int): index of the first frame of frame_list in the whole video
+            stop_at_first_match (bool): with early exit, yield only the first identity matched in a frame
 
-    def get_timestamps(self, frame_list: list[np.ndarray], frame_interval: int) -> set[int]:
+        Yields:
+            tuple[int, set[str]]: index of the processed frame, identities detected in it (possibly empty)
+        """
+        if len(self.known_faces) == 0:
+            raise NoKnownFaceEncodingsError()
+        for frame_index, frame in enumerate(frame_list, start=start_index):
+            if frame_index%frame_interval == 0:
+                yield frame_index, self.frame_labels(frame, stop_at_first_match=stop_at_first_match)
+
+    def get_timestamps(self, frame_list: list[np.ndarray], frame_interval: int, start_index: int = 0) -> set[int]:
         """    
         Iterate through frames and save frames where known face is detected
 
         Args:
             frame_list (list[np.ndarrat]): List of frames (NumPy arrays) extracted from the video.
+            frame_interval (int): frames interval to process
+            start_index (int): index of the first frame of frame_list in the whole video
         
         Returns:
             set[int]: A set of timestamps (frame indices) where known faces were detected.
         """
-        if not self.known_faces:
-            raise NoKnownFaceEncodingsError()
-        logger.info("Extracting timestamps")
-        timestamps = set()
-        for frame_index, frame in enumerate(frame_list):
-            if frame_index%frame_interval == 0:
-                face_encodings = self.detect_faces(frame)
-                # compare each detected face encoding to known faces
-                for face_encoding in face_encodings:
-                    if self.known_face_detected(face_encoding):
-                        timestamps.add(frame_index)
-
-        return timestamps
+        identity_timestamps = self.get_identity_timestamps(
+            frame_list, frame_interval, start_index, stop_at_first_match=True
+        )
+        return set().union(*identity_timestamps.values())
 
 #################################################################
 
-    def execute_with_images(self, train_faces_dir: Path, frame_list: list[np.ndarray], frame_interval: int) -> set[int]:
+    def execute_with_images(
+            self,
+            train_faces_dir: Path,
+            frame_list: list[np.ndarray],
+            frame_interval: int,
+            **scan_kwargs
+        ) -> set[int] | dict[str, set[int]]:
         """
         Train model on faces from images directory, and identify frames with known faces
         Args:
@@ -127,30 +379,41 @@ class FaceDetector():
             frame_interval (int): frames interval to process
         
         Returns:
-            set[int]: A set of timestamps (frame indices) where known faces were detected.
+            set[int] | dict[str, set[int]]: timestamps (frame indices) where known faces were detected.
         """
         self.train_from_images(train_faces_dir)
-        return self.get_timestamps(frame_list, frame_interval)
+        return self.execute_pretrained(frame_list, frame_interval, **scan_kwargs)
 
 
-    def execute_pretrained(self, frame_list: list[np.ndarray], frame_interval: int) -> set[int]:
+    def execute_pretrained(
+            self,
+            frame_list: list[np.ndarray],
+            frame_interval: int,
+            start_index: int = 0,
+            per_identity: bool = False
+        ) -> set[int] | dict[str, set[int]]:
         """
         Execute pipleine with model pretrained on known faces, and identify frames with known faces
         Args:
             frame_list (list[np.ndarrat]): List of frames (NumPy arrays) extracted from the video.
             frame_interval (int): frames interval to process
+            start_index (int): index of the first frame of frame_list in the whole video
+            per_identity (bool): if True, return detected frames separately for each identity
         
         Returns:
-            set[int]: A set of timestamps (frame indices) where known faces were detected.
+            set[int] | dict[str, set[int]]: timestamps (frame indices) where known faces were detected.
         """
-        return self.get_timestamps(frame_list, frame_interval)
+        if per_identity:
+            return self.get_identity_timestamps(frame_list, frame_interval, start_index)
+        return self.get_timestamps(frame_list, frame_interval, start_index)
 
     def execute_with_encodings(
             self,
             known_face_encodings: list[np.ndarray],
             frame_list: list[np.ndarray],
-            frame_interval: int
-        ) -> set[int]:
+            frame_interval: int,
+            **scan_kwargs
+        ) -> set[int] | dict[str, set[int]]:
         """
         Add known face encodings to known faces, and identify frames with known faces
         Args:
@@ -159,12 +422,12 @@ class FaceDetector():
             frame_interval (int): frames interval to process
         
         Returns:
-            set[int]: A set of timestamps (frame indices) where known faces were detected.
+            set[int] | dict[str, set[int]]: timestamps (frame indices) where known faces were detected.
         """
         self.train_from_encodings(known_face_encodings)
-        return self.get_timestamps(frame_list, frame_interval)
+        return self.execute_pretrained(frame_list, frame_interval, **scan_kwargs)
 
-    def execute(self, *args, **kwargs) -> set[int]:
+    def execute(self, *args, **kwargs) -> set[int] | dict[str, set[int]]:
         """
         Execute the pipeline based on provided arguments.
         
@@ -175,9 +438,11 @@ class FaceDetector():
         
         Optional Keyword Arguments:
             - frame_interval (int): Frames interval to process. Default is 10 (process every 10th frame)
+            - start_index (int): Index of the first frame of frames in the whole video. Default is 0
+            - per_identity (bool): Return a dict of timestamps per identity. Default is False
 
         Returns:
-            set[int]: A list of timestamps (frame indices) where known faces were detected.
+            set[int] | dict[str, set[int]]: timestamps (frame indices) where known faces were detected.
         """
         signature = tuple(
             Path if isinstance(arg, (PosixPath, WindowsPath)) else arg.__class__
@@ -190,8 +455,13 @@ class FaceDetector():
         }
         if signature in typemap:
             frame_interval = kwargs.get('frame_interval', 10)
-            return(typemap[signature](*args, frame_interval))
+            return(typemap[signature](
+                *args,
+                frame_interval,
+                start_index=kwargs.get('start_index', 0),
+                per_identity=kwargs.get('per_identity', False)
+            ))
         else:
             raise TypeError(f"Invalid type signature: {signature}. Accepted signatures are: Path, list), (list, list), or (list)." 
-                            "Optional keyword argument 'frame_interval' (int) is also supported.")
-
+                            "Optional keyword arguments 'frame_interval' (int), 'start_index' (int) "
+                            "and 'per_identity' (bool) are also supported.")
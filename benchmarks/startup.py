@@ -0,0 +1,90 @@
+"""Benchmark CLI startup: import cost of each subcommand
+
+Usage:
+    python -m benchmarks.startup [-r REPEAT]
+
+For every subcommand, measures in a fresh interpreter:
+
+    - startup: wall time of `cli {command} --help`, paid by help and usage errors
+    - imports: import time of the modules the command imports when it runs (COMMAND_IMPORTS)
+
+and reports the heavy libraries each path pulls in.
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# modules each subcommand imports in its body, keep in sync with cli.py
+COMMAND_IMPORTS = {
+    "detect-faces": ["ai.face_recognizer", "etl.extract"],
+    "generate-encodings": ["ai.face_recognizer"],
+    "migrate-encodings": [],
+    "plan": ["etl.plan"],
+    "run": ["ai.face_recognizer", "etl.extract", "etl.load", "etl.plan"],
+    "batch": ["ai.face_recognizer", "etl.extract", "etl.load", "etl.plan"],
+    "scan-shard": ["ai.face_recognizer", "etl.extract", "etl.shard"],
+    "merge": ["etl.load", "etl.shard"],
+}
+HEAVY_MODULES = ("face_recognition", "dlib", "cv2", "moviepy")
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)")
+
+
+def run_python(args: list[str]) -> tuple[float, str]:
+    """Run python with -X importtime, returns wall time in seconds and import time log"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], cwd=ROOT, capture_output=True, text=True, check=False
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"python {' '.join(args)} failed:\n{result.stderr[-2000:]}")
+    return elapsed, result.stderr
+
+
+def heavy_imports(import_log: str) -> list[str]:
+    """Returns heavy top level modules found in an import time log"""
+    imported = {match.group(3).split(".")[0] for match in IMPORT_TIME_PATTERN.finditer(import_log)}
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+def measure(args: list[str], repeat: int) -> tuple[float, list[str]]:
+    """Returns median wall time of repeat runs and heavy modules imported"""
+    times = []
+    for _ in range(repeat):
+        elapsed, import_log = run_python(args)
+        times.append(elapsed)
+    return statistics.median(times), heavy_imports(import_log)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per measure, median is reported")
+    args = parser.parse_args()
+
+    baseline, _ = measure(["-c", "pass"], args.repeat)
+    print(f"{'command':<20} {'startup ms':>11} {'imports ms':>11}  heavy modules")
+    print(f"{'(interpreter)':<20} {1000 * baseline:>11.0f}")
+
+    main_time, main_heavy = measure(["-m", "cli", "--help"], args.repeat)
+    print(f"{'--help':<20} {1000 * main_time:>11.0f} {'':>11}  {', '.join(main_heavy) or '-'}")
+
+    for command, modules in COMMAND_IMPORTS.items():
+        startup, startup_heavy = measure(["-m", "cli", command, "--help"], args.repeat)
+        body = ["-c", "; ".join(["import cli"] + [f"import {module}" for module in modules])]
+        try:
+            imports, imports_heavy = measure(body, args.repeat)
+        except RuntimeError as e:
+            print(f"{command:<20} {1000 * startup:>11.0f} {'failed':>11}  {str(e).splitlines()[-1]}")
+            continue
+        heavy = startup_heavy + [f"{module} (run)" for module in imports_heavy if module not in startup_heavy]
+        print(f"{command:<20} {1000 * startup:>11.0f} {1000 * (imports - main_time):>11.0f}  {', '.join(heavy) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
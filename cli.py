@@ -1,15 +1,96 @@
 """Script Orchestrator"""
+from datetime import datetime
 import logging
 from pathlib import Path
 import click
 import os
+import socket
 
-from ai.face_recognizer import FaceDetector
-from etl.extract import extract_frames, extract_batch_frames, get_total_frames
-from etl.load import process_extracted_frames
+# face_recognition (dlib), cv2 and moviepy take seconds to import: commands import
+# the modules they need when they run, so that --help and usage errors stay fast
+from ai import DEFAULT_LABEL, MODEL_VERSION
 
 import utils as u
 
+
+def segment_options(command):
+    """Add options controlling how detected frames are turned into clips"""
+    options = [
+        click.option("--pre-pad", default=None, type=click.IntRange(min=0),
+                     help="Frames kept before a detection. Default is clips-length / 3"),
+        click.option("--post-pad", default=None, type=click.IntRange(min=0),
+                     help="Frames kept after a detection. Default is 2 * clips-length / 3"),
+        click.option("--max-gap", default=0, type=click.IntRange(min=0),
+                     help="Detections closer than this number of frames are bridged in the same run"),
+        click.option("--min-hits", default=1, type=click.IntRange(min=1),
+                     help="Minimum number of detections in a run to open a clip"),
+        click.option("--min-duration", default=0, type=click.IntRange(min=0),
+                     help="Clips shorter than this number of frames are dropped"),
+        click.option("--max-duration", default=None, type=click.IntRange(min=1),
+                     help="Clips longer than this number of frames are split"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def detection_options(command):
+    """Add options controlling face detection"""
+    options = [
+        click.option("-s", "--detection-scale", default=1.0, type=click.FloatRange(min=0, max=1, min_open=True),
+                     help="Frames are resized by this factor before face detection. Default is 1 (full resolution)"),
+        click.option("--early-exit", default=False, is_flag=True,
+                     help="Encode faces from largest to smallest and stop at the first match in each frame"),
+        click.option("--min-face-size", default=0, type=click.IntRange(min=0),
+                     help="Faces smaller than this number of pixels are ignored. Default is 0 (no limit)"),
+        click.option("--crop", default=False, is_flag=True,
+                     help="Detect faces only in the active region of the frame, without black bars and static borders"),
+        click.option("--roi", default=None, nargs=4, metavar="X Y WIDTH HEIGHT",
+                     type=(click.IntRange(min=0), click.IntRange(min=0), click.IntRange(min=1), click.IntRange(min=1)),
+                     help="Detect faces only in this region of the frame"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def auto_options(command):
+    """Add options controlling automatic tuning of detection settings"""
+    options = [
+        click.option("--auto", default=False, is_flag=True,
+                     help="Pick frame interval, batch size and detection scale with a dry run (see plan command)"),
+        click.option("--time-resolution", default=0.5, type=click.FloatRange(min=0, min_open=True),
+                     help="With --auto, maximum number of seconds between two analyzed frames. Default is 0.5"),
+        click.option("--memory-budget", default=2048, type=click.IntRange(min=1),
+                     help="With --auto, maximum memory in MB used by decoded frames. Default is 2048"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def warn_overridden_options(ctx: click.core.Context, planned: dict) -> None:
+    """Warn when --auto replaces the value of an option given by the user"""
+    for name, value in planned.items():
+        if ctx.get_parameter_source(name) != click.core.ParameterSource.DEFAULT and ctx.params[name] != value:
+            ctx.obj["logger"].warning(
+                f"--auto overrides --{name.replace('_', '-')} {ctx.params[name]} with {value}"
+            )
+
+
+def train_face_detector(face_detector, images_dir: Path | None, encodings_file: Path | None) -> None:
+    """Train face detector from a gallery, .npy encodings, a directory of {label}.npy files or images"""
+    if encodings_file and encodings_file.suffix == u.GALLERY_EXT:
+        face_detector.train_from_gallery(u.load_gallery(encodings_file))
+    elif encodings_file and encodings_file.is_dir():
+        face_detector.train_from_labelled_encodings(u.load_labelled_encodings(encodings_file))
+    elif encodings_file:
+        encodings = u.load_encodings(encodings_file)
+        face_detector.train_from_encodings(encodings)
+    else:
+        face_detector.train_from_images(images_dir)
+
+
 @click.group()
 @click.option(
     "-l",
@@ -25,18 +106,35 @@ import utils as u
     is_flag=True,
     help="Set logging level to WARN, default is DEBUG",
 )
+@click.option(
+    "--profile",
+    default=False,
+    is_flag=True,
+    help="Profile the command, and save pstats, collapsed stacks and timers of hot functions to log-dir. "
+    "In run and batch, clips are written by background processes: clip writing is in the timers "
+    "but not in pstats nor collapsed stacks",
+)
 @click.pass_context
 def main(
-    ctx: click.core.Context, log_dir: Path | None, quiet: bool
+    ctx: click.core.Context, log_dir: Path | None, quiet: bool, profile: bool
 ):
     """CLI endpoint. Orchestrate all commands."""
     
+    if profile and log_dir is None:
+        raise click.UsageError("--profile requires --log-dir.")
+
     #initialize logger
     logger = u.config_logger(
         log_dir=log_dir, level=logging.INFO if quiet else logging.DEBUG
     )
     logger.info("Starting main.")
 
+    if profile:
+        profiler = u.Profiler()
+        profiler.start()
+        # subcommand runs before the group context is closed
+        ctx.call_on_close(lambda: profiler.stop(log_dir))
+
     ctx.obj = {
         "logger": logger
     }
@@ -69,19 +167,26 @@ def main(
     "-o",
     "--output-path",
     required=True,
-    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    type=click.Path(dir_okay=False, path_type=Path),
     help="Output file",
 )
 @click.pass_context
 def detect_faces(ctx: click.core.Context, images_dir: Path, video_path: Path, frame_interval: int, output_path: Path):
+    from ai.face_recognizer import FaceDetector
+    from etl.extract import extract_frames
+
     #extract logger
     logger = ctx.obj["logger"]
     
     logger.info("Starting detect faces")
-    frames = extract_frames(video_path)
-    
+    # train before decoding the video, so that missing faces are reported early
     face_detector = FaceDetector()
-    timestamps = face_detector.execute(images_dir, frames, frame_interval=frame_interval)
+    face_detector.train_from_images(images_dir)
+    if len(face_detector.get_known_faces()) == 0:
+        raise ValueError("No face encodings found")
+
+    frames = extract_frames(video_path)
+    timestamps = face_detector.execute(frames, frame_interval=frame_interval)
     timestamps = sorted(timestamps)
     u.save_txt(str(timestamps), output_path)
 
@@ -98,8 +203,9 @@ def detect_faces(ctx: click.core.Context, images_dir: Path, video_path: Path, fr
     "-o",
     "--output-path",
     required=True,
-    type=click.Path(exists=True, dir_okay=False, path_type=Path),
-    help="Output file",
+    type=click.Path(path_type=Path),
+    help="Output .gallery file (appended to if it exists), .npy file, "
+    "or existing directory where to save one {label}.npy file per identity",
 )
 @click.pass_context
 def generate_encodings(ctx: click.core.Context, images_dir: Path, output_path: Path):
@@ -111,15 +217,112 @@ def generate_encodings(ctx: click.core.Context, images_dir: Path, output_path: P
             logger.critical(f"Images folder {images_dir} not found")
             return
     
-    if not u.has_right_extension(output_path, ext=".npy"):
-            logger.critical(f"Encodings file must be .npy - found: {output_path}")
+    if not output_path.is_dir() and output_path.suffix not in (u.GALLERY_EXT, ".npy"):
+            logger.critical(f"Encodings file must be {u.GALLERY_EXT} or .npy - found: {output_path}")
             return
 
+    from ai.face_recognizer import FaceDetector
+
     logger.info("Starting generate encodings")
     face_detector = FaceDetector()
+    if output_path.suffix == u.GALLERY_EXT:
+        # only encode images that are not in the gallery yet, and append them
+        skip_sources = set()
+        if output_path.exists():
+            skip_sources = {source.decode() for source in u.load_gallery(output_path).source_hashes}
+        face_detector.train_from_images(images_dir, skip_sources=skip_sources)
+        u.append_to_gallery(
+            output_path,
+            face_detector.get_known_faces(),
+            face_detector.get_known_labels(),
+            face_detector.get_known_sources(),
+            MODEL_VERSION
+        )
+        return
+
     face_detector.train_from_images(images_dir)
-    encodings = face_detector.get_known_faces()
-    u.save_encodings(encodings, output_path)
+    if output_path.is_dir():
+        u.save_labelled_encodings(face_detector.get_labelled_faces(), output_path)
+    else:
+        encodings = face_detector.get_known_faces()
+        u.save_encodings(encodings, output_path)
+
+
+@main.command()
+@click.option(
+    "-e",
+    "--encodings-file",
+    required=True,
+    type=click.Path(exists=True, path_type=Path),
+    help="Legacy .npy encodings file, or directory with one {label}.npy file per identity",
+)
+@click.option(
+    "-o",
+    "--output-path",
+    required=True,
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Output .gallery file, appended to if it exists",
+)
+@click.option(
+    "--allow-pickle",
+    default=False,
+    is_flag=True,
+    help="Read ragged encodings saved as object arrays by older versions. Unpickling can run code: trusted files only",
+)
+@click.pass_context
+def migrate_encodings(ctx: click.core.Context, encodings_file: Path, output_path: Path, allow_pickle: bool):
+    #extract logger
+    logger = ctx.obj["logger"]
+
+    # validation steps
+    if output_path.suffix != u.GALLERY_EXT:
+            logger.critical(f"Gallery file must be {u.GALLERY_EXT} - found: {output_path}")
+            return
+
+    logger.info("Starting migrate encodings")
+    u.migrate_encodings(encodings_file, output_path, MODEL_VERSION, DEFAULT_LABEL, allow_pickle=allow_pickle)
+
+
+@main.command()
+@click.option(
+    "-v",
+    "--video-path",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Path to video to analyze",
+)
+@click.option(
+    "-t",
+    "--time-resolution",
+    default=0.5,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of seconds between two analyzed frames. Default is 0.5",
+)
+@click.option(
+    "-m",
+    "--memory-budget",
+    default=2048,
+    type=click.IntRange(min=1),
+    help="Maximum memory in MB used by decoded frames. Default is 2048",
+)
+@click.option(
+    "-n",
+    "--sample-size",
+    default=20,
+    type=click.IntRange(min=1),
+    help="Number of frames used to time face detection. Default is 20",
+)
+@click.pass_context
+def plan(ctx: click.core.Context, video_path: Path, time_resolution: float, memory_budget: int, sample_size: int):
+    """Estimate runtime and memory, and log the settings to use for run or batch"""
+    from etl.plan import plan_settings
+
+    logger = ctx.obj["logger"]
+
+    logger.info("Starting plan")
+    settings = plan_settings(video_path, time_resolution, memory_budget, sample_size)
+    mode = "run" if settings["fits_in_memory"] else f"batch -b {settings['batch_size']}"
+    logger.info(f"Suggested command: {mode} -f {settings['frame_interval']} -s {settings['scale']}")
 
 
 @main.command()
@@ -134,8 +337,8 @@ def generate_encodings(ctx: click.core.Context, images_dir: Path, output_path: P
     "-e",
     "--encodings-file",
     required=False,  # Not required if images-dir is provided
-    type=click.Path(exists=True, dir_okay=False, path_type=Path),
-    help="File with pre-saved face encodings",
+    type=click.Path(exists=True, path_type=Path),
+    help="Gallery or .npy file with pre-saved face encodings, or directory with one {label}.npy file per identity",
 )
 @click.option(
     "-v",
@@ -167,6 +370,23 @@ def generate_encodings(ctx: click.core.Context, images_dir: Path, output_path: P
     type=click.Path(exists=True, file_okay=False, path_type=Path),
     help="Directory where extracted clips are saved",
 )
+@click.option(
+    "-p",
+    "--per-identity",
+    default=False,
+    is_flag=True,
+    help="Save clips of each identity in its own subdirectory of output-dir",
+)
+@click.option(
+    "-w",
+    "--writers",
+    default=2,
+    type=click.IntRange(min=1),
+    help="Number of background processes writing clips while the video is scanned. Default is 2",
+)
+@detection_options
+@auto_options
+@segment_options
 @click.pass_context
 def run(
     ctx: click.core.Context,
@@ -175,34 +395,65 @@ def run(
     video_path: Path,
     frame_interval: int,
     clips_length: int,
-    output_dir: Path
+    output_dir: Path,
+    per_identity: bool,
+    writers: int,
+    detection_scale: float,
+    early_exit: bool,
+    min_face_size: int,
+    crop: bool,
+    roi: tuple[int, int, int, int] | None,
+    auto: bool,
+    time_resolution: float,
+    memory_budget: int,
+    **segment_kwargs
 ):
     logger = ctx.obj["logger"]
     
     # validation steps
     u.validate_encodings_source(images_dir, encodings_file)
 
+    from ai.face_recognizer import FaceDetector
+    from etl.extract import extract_frames, get_detection_region
+    from etl.load import ClipWriter
+    from etl.plan import plan_settings
+
     if not Path(video_path).exists:
         logger.critical(f"Input video {video_path} not found")
 
     if not os.path.isdir(output_dir):
         logger.critical(f"Output folder {output_dir} not found")
 
+    if auto:
+        settings = plan_settings(video_path, time_resolution, memory_budget)
+        frame_interval, detection_scale = settings["frame_interval"], settings["scale"]
+        warn_overridden_options(ctx, {"frame_interval": frame_interval, "detection_scale": detection_scale})
+        if not settings["fits_in_memory"]:
+            logger.warning(f"Video frames do not fit in memory budget, consider batch -b {settings['batch_size']}")
+
     logger.info("Extracting frames from video")
     frames = extract_frames(video_path)
     
-    face_detector = FaceDetector()
-    if encodings_file:
-        encodings = u.load_encodings(encodings_file)
-        face_detector.train_from_encodings(encodings)
-    else:
-        face_detector.train_from_images(images_dir)
+    region = get_detection_region(video_path, crop=crop, roi=roi)
+    face_detector = FaceDetector(
+        scale=detection_scale, early_exit=early_exit, min_face_size=min_face_size, region=region
+    )
+    train_face_detector(face_detector, images_dir, encodings_file)
     
     if len(face_detector.get_known_faces()) == 0:
         raise ValueError("No face encodings found")
 
-    timestamps = face_detector.execute(frames, frame_interval=frame_interval)
-    process_extracted_frames(video_path, timestamps, output_dir, clips_length=clips_length)
+    # clips are written in background as soon as their segment is closed
+    clip_writer = ClipWriter(
+        video_path, output_dir, clips_length=clips_length, per_identity=per_identity, workers=writers, **segment_kwargs
+    )
+    for frame_index, labels in face_detector.iter_frame_labels(
+        frames, frame_interval, stop_at_first_match=not per_identity
+    ):
+        clip_writer.advance(frame_index)
+        if labels:
+            clip_writer.push(frame_index, labels)
+    clip_writer.close()
 
 
 @main.command()
@@ -217,8 +468,8 @@ def run(
     "-e",
     "--encodings-file",
     required=False,  # Not required if images-dir is provided
-    type=click.Path(exists=True, dir_okay=False, path_type=Path),
-    help="File with pre-saved face encodings",
+    type=click.Path(exists=True, path_type=Path),
+    help="Gallery or .npy file with pre-saved face encodings, or directory with one {label}.npy file per identity",
 )
 @click.option(
     "-v",
@@ -258,6 +509,23 @@ def run(
     type=click.Path(exists=True, file_okay=False, path_type=Path),
     help="Output file",
 )
+@click.option(
+    "-p",
+    "--per-identity",
+    default=False,
+    is_flag=True,
+    help="Save clips of each identity in its own subdirectory of output-dir",
+)
+@click.option(
+    "-w",
+    "--writers",
+    default=2,
+    type=click.IntRange(min=1),
+    help="Number of background processes writing clips while the video is scanned. Default is 2",
+)
+@detection_options
+@auto_options
+@segment_options
 @click.pass_context
 def batch(
     ctx: click.core.Context,
@@ -267,12 +535,28 @@ def batch(
     frame_interval: int,
     batch_size: int,
     clips_length: int,
-    output_dir: Path
+    output_dir: Path,
+    per_identity: bool,
+    writers: int,
+    detection_scale: float,
+    early_exit: bool,
+    min_face_size: int,
+    crop: bool,
+    roi: tuple[int, int, int, int] | None,
+    auto: bool,
+    time_resolution: float,
+    memory_budget: int,
+    **segment_kwargs
 ):
     logger = ctx.obj["logger"]
     
     # validation steps
     u.validate_encodings_source(images_dir, encodings_file)
+
+    from ai.face_recognizer import FaceDetector
+    from etl.extract import extract_batch_frames, get_detection_region, get_total_frames
+    from etl.load import ClipWriter
+    from etl.plan import plan_settings
     
     if not Path(video_path).exists:
         logger.critical(f"Input video {video_path} not found")
@@ -280,34 +564,286 @@ def batch(
     if not os.path.isdir(output_dir):
         logger.critical(f"Output folder {output_dir} not found")
     
+    if auto:
+        settings = plan_settings(video_path, time_resolution, memory_budget)
+        frame_interval, batch_size, detection_scale = (
+            settings["frame_interval"], settings["batch_size"], settings["scale"]
+        )
+        warn_overridden_options(
+            ctx, {"frame_interval": frame_interval, "batch_size": batch_size, "detection_scale": detection_scale}
+        )
 
     logger.info("Extracting frames from video")
     current_frame = 0
     total_frames = get_total_frames(video_path)
     logger.debug(f"Total frames in video: {total_frames}")
     #initialize face detector
-    face_detector = FaceDetector()
-    if encodings_file:
-        encodings = u.load_encodings(encodings_file)
-        face_detector.train_from_encodings(encodings)
-    else:
-        face_detector.train_from_images(images_dir)
+    region = get_detection_region(video_path, crop=crop, roi=roi)
+    face_detector = FaceDetector(
+        scale=detection_scale, early_exit=early_exit, min_face_size=min_face_size, region=region
+    )
+    train_face_detector(face_detector, images_dir, encodings_file)
 
-    timestamp_lists = []
+    # clips are written in background as soon as their segment is closed
+    clip_writer = ClipWriter(
+        video_path, output_dir, clips_length=clips_length, per_identity=per_identity, workers=writers, **segment_kwargs
+    )
     batch_count = 1
     logger.info("Starting batch processing")
     while current_frame < total_frames:
         frames = extract_batch_frames(video_path, current_frame, batch_size, total_frames)
 
-        timestamp_lists.append(face_detector.execute(frames, frame_interval=frame_interval))
+        for frame_index, labels in face_detector.iter_frame_labels(
+            frames, frame_interval, start_index=current_frame, stop_at_first_match=not per_identity
+        ):
+            clip_writer.advance(frame_index)
+            if labels:
+                clip_writer.push(frame_index, labels)
         current_frame += batch_size
         logger.debug(f"Processed batch {batch_count}")
         batch_count += 1
         # clear memory
         frames = []
 
-    process_extracted_frames(video_path, timestamp_lists, output_dir, clips_length=clips_length)
+    clip_writer.close()
     
 
+
+@main.command()
+@click.option(
+    "-i",
+    "--images-dir",
+    required=False,  # Not required if encodings-file is provided
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Directory with training face images",
+)
+@click.option(
+    "-e",
+    "--encodings-file",
+    required=False,  # Not required if images-dir is provided
+    type=click.Path(exists=True, path_type=Path),
+    help="Gallery or .npy file with pre-saved face encodings, or directory with one {label}.npy file per identity",
+)
+@click.option(
+    "-v",
+    "--video-path",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Path to video to analyze",
+)
+@click.option(
+    "-f",
+    "--frame-interval",
+    required=False,
+    default=15,
+    type=click.IntRange(min=1),
+    help="Frame interval to process. Default is 15 (process every 15th frame)",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    required=False,
+    default=2000,
+    type=click.IntRange(min=1),
+    help="Number of frames to be processed in each batch",
+)
+@click.option(
+    "--shard",
+    default=None,
+    type=str,
+    help="Shard to scan, as i/N (shard i, starting from 0, of N equal shards)",
+)
+@click.option(
+    "--frame-range",
+    default=None,
+    type=int,
+    nargs=2,
+    metavar="START END",
+    help="Explicit [START, END) frame range to scan, START must be a multiple of frame-interval",
+)
+@click.option(
+    "-p",
+    "--per-identity",
+    default=False,
+    is_flag=True,
+    help="Record detections of each identity, so that merge can save clips per identity",
+)
+@click.option(
+    "-o",
+    "--output-path",
+    required=True,
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Output detections .json file",
+)
+@detection_options
+@click.pass_context
+def scan_shard(
+    ctx: click.core.Context,
+    images_dir: Path,
+    encodings_file: Path,
+    video_path: Path,
+    frame_interval: int,
+    batch_size: int,
+    shard: str | None,
+    frame_range: tuple[int, int] | None,
+    per_identity: bool,
+    output_path: Path,
+    detection_scale: float,
+    early_exit: bool,
+    min_face_size: int,
+    crop: bool,
+    roi: tuple[int, int, int, int] | None,
+):
+    """Scan a shard of the video and save detections with global frame indices, see merge"""
+    logger = ctx.obj["logger"]
+
+    # validation steps
+    u.validate_encodings_source(images_dir, encodings_file)
+
+    if (shard is None) == (frame_range is None):
+        raise click.UsageError("You must provide either --shard or --frame-range.")
+
+    from etl.shard import build_detections, parse_shard, shard_bounds
+
+    shard_index, shard_count = None, None
+    if shard is not None:
+        try:
+            shard_index, shard_count = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--shard") from e
+
+    from ai.face_recognizer import FaceDetector
+    from etl.extract import extract_batch_frames, get_detection_region, probe_video
+
+    try:
+        video_info = probe_video(video_path)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--video-path") from e
+    total_frames = video_info["total_frames"]
+    if shard is not None:
+        start_frame, end_frame = shard_bounds(total_frames, shard_index, shard_count, frame_interval)
+    else:
+        start_frame, end_frame = frame_range
+        if start_frame % frame_interval or not 0 <= start_frame < end_frame <= total_frames:
+            raise click.BadParameter(
+                f"must be a range of [0, {total_frames}] starting on a multiple of {frame_interval}",
+                param_hint="--frame-range",
+            )
+    logger.info(f"Scanning frames {start_frame} to {end_frame} of {total_frames}")
+
+    region = get_detection_region(video_path, crop=crop, roi=roi)
+    face_detector = FaceDetector(
+        scale=detection_scale, early_exit=early_exit, min_face_size=min_face_size, region=region
+    )
+    train_face_detector(face_detector, images_dir, encodings_file)
+
+    if len(face_detector.get_known_faces()) == 0:
+        raise ValueError("No face encodings found")
+
+    started = datetime.now()
+    identity_frames = {}
+    current_frame = start_frame
+    while current_frame < end_frame:
+        frames = extract_batch_frames(video_path, current_frame, batch_size, end_frame)
+        for frame_index, labels in face_detector.iter_frame_labels(
+            frames, frame_interval, start_index=current_frame, stop_at_first_match=not per_identity
+        ):
+            for label in labels:
+                identity_frames.setdefault(label, []).append(frame_index)
+        current_frame += batch_size
+        # clear memory
+        frames = []
+    finished = datetime.now()
+
+    detections = build_detections(
+        video={
+            "name": video_path.name,
+            "fingerprint": u.fingerprint_file(video_path),
+            "total_frames": total_frames,
+            "fps": video_info["fps"],
+        },
+        settings={
+            "frame_interval": frame_interval,
+            "detection_scale": detection_scale,
+            "early_exit": early_exit,
+            "min_face_size": min_face_size,
+            "region": list(region) if region else None,
+            "per_identity": per_identity,
+            "model_version": MODEL_VERSION,
+            "known_faces": face_detector.get_fingerprint(),
+        },
+        shard={"index": shard_index, "count": shard_count, "start": start_frame, "end": end_frame},
+        run={
+            "host": socket.gethostname(),
+            "started": started.isoformat(),
+            "finished": finished.isoformat(),
+            "seconds": (finished - started).total_seconds(),
+        },
+        identity_frames=identity_frames,
+    )
+    u.save_json(detections, output_path)
+    logger.info(f"Saved detections of frames {start_frame} to {end_frame} to {output_path}")
+
+
+@main.command()
+@click.option(
+    "-d",
+    "--detections",
+    required=True,
+    multiple=True,
+    type=click.Path(exists=True, path_type=Path),
+    help="Detections .json file of a shard, or directory of detections files. Can be repeated",
+)
+@click.option(
+    "-v",
+    "--video-path",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Path to the scanned video",
+)
+@click.option(
+    "-l",
+    "--clips-length",
+    required=False,
+    default=1800,
+    type=int,
+    help="Length of output clips in frames",
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Directory where extracted clips are saved",
+)
+@segment_options
+@click.pass_context
+def merge(
+    ctx: click.core.Context,
+    detections: tuple[Path],
+    video_path: Path,
+    clips_length: int,
+    output_dir: Path,
+    **segment_kwargs
+):
+    """Check that scan-shard detections cover the whole video, combine them and extract clips"""
+    logger = ctx.obj["logger"]
+
+    from etl.load import process_extracted_frames
+    from etl.shard import merge_detections
+
+    detections_paths = []
+    for path in detections:
+        detections_paths.extend(sorted(path.glob("*.json")) if path.is_dir() else [path])
+    logger.info(f"Merging {len(detections_paths)} detections files")
+
+    identity_frames, metadata = merge_detections([u.load_json(path) for path in detections_paths])
+    if u.fingerprint_file(video_path) != metadata["video"]["fingerprint"]:
+        raise click.BadParameter(f"{video_path} is not the scanned video", param_hint="--video-path")
+
+    frames = identity_frames if metadata["settings"]["per_identity"] else set().union(*identity_frames.values())
+    process_extracted_frames(video_path, frames, output_dir, clips_length=clips_length, **segment_kwargs)
+
+
 if __name__ == "__main__":
     main()
@@ -1,12 +1,29 @@
 """Extract audio and frames from video"""
 import logging
+import time
 from pathlib import Path
 
 import cv2
 import numpy as np
 
+from utils.profiling import timed
+
 logger = logging.getLogger()
 
+
+@timed
+def read_frame(cap: cv2.VideoCapture) -> np.ndarray | None:
+    """Decode next frame of the video, returns None at the end of the video"""
+    success, frame = cap.read()
+    return frame if success else None
+
+
+@timed
+def to_rgb(frame: np.ndarray) -> np.ndarray:
+    """Convert a BGR frame decoded by OpenCV to RGB"""
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
 def extract_frames(video_path: Path) -> list[np.ndarray]:
     """Extract frames from video
     
@@ -32,14 +49,14 @@ def extract_frames(video_path: Path) -> list[np.ndarray]:
     frame_count = 0  # Frame counter
 
     # Read first frame from the video
-    success, frame = cap.read()
+    frame = read_frame(cap)
 
-    while success:
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    while frame is not None:
+        frame = to_rgb(frame)
         # Store the frame in memory as a NumPy array
         frame_list.append(frame)
         frame_count += 1
-        success, frame = cap.read()
+        frame = read_frame(cap)
 
     # close video file
     cap.release()
@@ -78,13 +95,13 @@ def extract_batch_frames(video_path: Path, start_frame: int, batch_size: int, to
 
     # Extract frames from start_frame to start_frame + batch_size (or until the end of the video)
     while current_frame < (start_frame + batch_size) and current_frame < total_frames:
-        ret, frame = cap.read()
+        frame = read_frame(cap)
 
-        if not ret:
+        if frame is None:
             logger.error(f"Error reading frame at {current_frame}")
             break
         
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame = to_rgb(frame)
 
         frames_list.append(frame)
         current_frame += 1
@@ -108,3 +125,187 @@ def get_total_frames(video_path):
     
     cap.release()  # Release the video file resource
     return total_frames
+
+
+
+def open_video(video_path: Path) -> cv2.VideoCapture:
+    """Open video file with OpenCV, raising ValueError if it cannot be opened"""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        logger.error(f"Could not open video file {video_path}")
+        raise ValueError(f"Could not open video file {video_path}")
+    return cap
+
+
+def probe_video(video_path: Path) -> dict:
+    """
+    Returns video properties: width, height, fps, total_frames and codec (FourCC)
+    """
+    cap = open_video(video_path)
+
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    video_info = {
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "fps": cap.get(cv2.CAP_PROP_FPS),
+        "total_frames": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        "codec": "".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip("\0 "),
+    }
+
+    cap.release()
+    logger.debug(f"Probed video {video_path}: {video_info}")
+    return video_info
+
+
+def sample_frames(video_path: Path, sample_size: int, total_frames: int) -> list[np.ndarray]:
+    """
+    Extract sample_size frames evenly spaced across the video
+
+    Args:
+        video_path (Path): path of video to process
+        sample_size (int): number of frames to extract
+        total_frames (int): total number of frames in the video
+
+    Returns:
+        list[np.ndarray]: list of sampled frames, frames that cannot be read are skipped
+    """
+    cap = open_video(video_path)
+
+    frames_list = []
+    for frame_index in np.linspace(0, total_frames - 1, num=min(sample_size, total_frames), dtype=int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_index))
+        ret, frame = cap.read()
+        if not ret:
+            logger.error(f"Error reading frame at {frame_index}")
+            continue
+        frames_list.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    cap.release()
+    return frames_list
+
+
+def time_decode(video_path: Path, frame_count: int, start_frame: int = 0) -> float:
+    """
+    Returns the average time in seconds to read and convert one frame, measured on frame_count consecutive frames
+    """
+    cap = open_video(video_path)
+
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    decoded = 0
+    start = time.perf_counter()
+    while decoded < frame_count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        decoded += 1
+    elapsed = time.perf_counter() - start
+
+    cap.release()
+    return elapsed / max(decoded, 1)
+
+
+def find_active_region(
+        video_path: Path,
+        sample_size: int = 8,
+        black_threshold: float = 16,
+        static_threshold: float = 2,
+        margin: float = 0.05
+    ) -> tuple[int, int, int, int] | None:
+    """
+    Find the region of the frame where faces can appear, from a handful of frames sampled across the video.
+
+    Rows and columns that stay black in every sample (letterbox, pillarbox) are cut. Borders whose pixels
+    never change across samples (scoreboards, logos, picture-in-picture frames) are cut too, keeping a
+    margin around the changing area. Static regions fully surrounded by changing pixels are kept.
+
+    Args:
+        video_path (Path): path of video to analyze
+        sample_size (int): number of frames to sample
+        black_threshold (float): rows and columns with mean gray level below this value are black
+        static_threshold (float): pixels whose gray level standard deviation is below this value are static
+        margin (float): fraction of frame size kept around the changing area
+
+    Returns:
+        tuple[int, int, int, int] | None: (top, right, bottom, left) active region, the whole frame if nothing
+            can be cut, None if no sample frame could be read
+    """
+    total_frames = probe_video(video_path)["total_frames"]
+    frames = sample_frames(video_path, sample_size, total_frames)
+    if not frames:
+        logger.warning(f"Could not read sample frames of video {video_path}, detection region not cropped")
+        return None
+    gray = np.stack([cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) for frame in frames]).astype(np.float32)
+    height, width = gray.shape[1:]
+
+    # black bars: rows / columns that are dark in every sample
+    active_rows = np.flatnonzero(gray.mean(axis=2).max(axis=0) >= black_threshold)
+    active_cols = np.flatnonzero(gray.mean(axis=1).max(axis=0) >= black_threshold)
+    if len(active_rows) == 0 or len(active_cols) == 0:
+        logger.warning(f"Video {video_path} sample frames are black, detection region not cropped")
+        return 0, width, height, 0
+    top, bottom = active_rows[0], active_rows[-1] + 1
+    left, right = active_cols[0], active_cols[-1] + 1
+
+    # static borders: bounding box of pixels that change across samples
+    if len(frames) > 1:
+        moving = gray[:, top:bottom, left:right].std(axis=0) > static_threshold
+        moving_rows = np.flatnonzero(moving.mean(axis=1) > 0.01)
+        moving_cols = np.flatnonzero(moving.mean(axis=0) > 0.01)
+        if len(moving_rows) and len(moving_cols):
+            row_margin, col_margin = int(margin * height), int(margin * width)
+            top, bottom = (
+                max(top + moving_rows[0] - row_margin, top), min(top + moving_rows[-1] + 1 + row_margin, bottom)
+            )
+            left, right = (
+                max(left + moving_cols[0] - col_margin, left), min(left + moving_cols[-1] + 1 + col_margin, right)
+            )
+
+    region = (int(top), int(right), int(bottom), int(left))
+    logger.info(
+        f"Active region {region} covers {100 * (bottom - top) * (right - left) / (height * width):.0f}% of the frame"
+    )
+    return region
+
+
+def get_detection_region(
+        video_path: Path,
+        crop: bool = False,
+        roi: tuple[int, int, int, int] | None = None
+    ) -> tuple[int, int, int, int] | None:
+    """
+    Combine the active region of the video and a user region of interest
+
+    Args:
+        video_path (Path): path of video to analyze
+        crop (bool): if True, detect the active region of the video (see find_active_region)
+        roi (tuple[int, int, int, int] | None): user region of interest as (x, y, width, height)
+
+    Returns:
+        tuple[int, int, int, int] | None: (top, right, bottom, left) region where to detect faces, None for the whole frame
+    """
+    region = find_active_region(video_path) if crop else None
+    if roi:
+        x, y, width, height = roi
+        if x < 0 or y < 0 or width < 1 or height < 1:
+            raise ValueError(f"Region of interest must have x, y >= 0 and width, height >= 1 - found: {roi}")
+        video_info = probe_video(video_path)
+        # clamp to the frame, so that the region can be used as slice bounds
+        user_region = (
+            min(y, video_info["height"]),
+            min(x + width, video_info["width"]),
+            min(y + height, video_info["height"]),
+            min(x, video_info["width"]),
+        )
+        if region is None:
+            region = user_region
+        else:
+            region = (
+                max(region[0], user_region[0]),
+                min(region[1], user_region[1]),
+                min(region[2], user_region[2]),
+                max(region[3], user_region[3]),
+            )
+        if region[0] >= region[2] or region[3] >= region[1]:
+            raise ValueError(f"Region of interest {roi} does not intersect the active region of the frame")
+    return region
@@ -1,16 +1,24 @@
 import logging
+import multiprocessing
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from utils.io import save_video
-from utils.process import get_datetime, merge_overlapping_ranges
+from utils.io import link_file, save_video
+from utils.profiling import add_timers, run_timed, timers_enabled
+from utils.process import SegmentStream, get_datetime, get_segments, merge_segments, split_segments
+
+from typing import TYPE_CHECKING
 
 import cv2
-from moviepy.video.io.VideoFileClip import VideoFileClip, VideoClip
+import numpy as np
+
+if TYPE_CHECKING:
+    from moviepy.video.io.VideoFileClip import VideoClip
 
 logger = logging.getLogger()
 
-def extract_video(video_path: Path, start: int, end: int) -> VideoClip:
+def extract_video(video_path: Path, start: int, end: int) -> "VideoClip":
     """
     Extract video from starting frame to ending frame
 
@@ -21,6 +29,9 @@ def extract_video(video_path: Path, start: int, end: int) -> VideoClip:
     Returns:
         VideoClip: video object to write in file
     """
+    # imported here, only clip writers need moviepy
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+
     video_path = str(video_path)
     video = VideoFileClip(video_path)
     fps = video.fps
@@ -32,7 +43,17 @@ def extract_video(video_path: Path, start: int, end: int) -> VideoClip:
     return video_subclip
 
 
-def get_frame_ranges(frames_set_list: list[set[int]] | set[int], clip_length: int, video_length: int,) -> list[tuple[int, int]]:
+def get_frame_ranges(
+        frames_set_list: list[set[int]] | set[int],
+        clip_length: int,
+        video_length: int,
+        pre_pad: int | None = None,
+        post_pad: int | None = None,
+        max_gap: int = 0,
+        min_hits: int = 1,
+        min_duration: int = 0,
+        max_duration: int | None = None
+    ) -> list[tuple[int, int]]:
     """
     Get list of (start, end) from list of sets of frames. Used to later extract videos
 
@@ -40,43 +61,319 @@ def get_frame_ranges(frames_set_list: list[set[int]] | set[int], clip_length: in
         frames_set_list (list[set[int]] | set[int]): list of sets or single set of frame indices
         clip_length (int): number of frames per clip
         video_length (int): total number of frames of input video
+        pre_pad (int | None): frames kept before a detection. Default is clip_length / 3
+        post_pad (int | None): frames kept after a detection. Default is 2 * clip_length / 3
+        max_gap, min_hits, min_duration, max_duration: see utils.process.get_segments
     
     Returns:
         list[tuple[int, int]]: list of (start, end) frame indices
     """
+    segments = get_segments(
+        frames_set_list,
+        pre_pad=clip_length // 3 if pre_pad is None else pre_pad,
+        post_pad=2 * clip_length // 3 if post_pad is None else post_pad,
+        video_length=video_length,
+        max_gap=max_gap,
+        min_hits=min_hits,
+        min_duration=min_duration,
+        max_duration=max_duration,
+    )
     
-    frames_set = set().union(*frames_set_list) if isinstance(frames_set_list, list) else frames_set_list
-    
-    ranges = [(max(i - clip_length/3, 0), min(i + int(2*clip_length/3), video_length)) for i in frames_set]
-    ranges.sort()
+    return [(start, end) for start, end in segments.tolist()]
 
-    merged_ranges = merge_overlapping_ranges(ranges)
-    
-    return merged_ranges
+
+def get_identity_frame_ranges(
+        identity_frames: dict[str, list[set[int]] | set[int]],
+        clip_length: int,
+        video_length: int,
+        max_duration: int | None = None,
+        **segment_options
+    ) -> list[tuple[int, int, list[str]]]:
+    """
+    Get list of (start, end, labels) from frames detected for each identity.
+    Where ranges of different identities overlap, the shared part is cut once (see group_identity_segments).
+
+    Args:
+        identity_frames (dict[str, list[set[int]] | set[int]]): frame indices detected for each identity
+        clip_length (int): number of frames per clip
+        video_length (int): total number of frames of input video
+        max_duration (int | None): maximum number of frames of a range, None for no limit
+        segment_options: other keyword arguments of get_frame_ranges
+
+    Returns:
+        list[tuple[int, int, list[str]]]: list of (start, end) frame indices with the identities they contain
+    """
+    identity_segments = {
+        label: np.asarray(get_frame_ranges(frames, clip_length, video_length, **segment_options), dtype=np.int64)
+        for label, frames in identity_frames.items()
+    }
+    return group_identity_segments(identity_segments, max_duration=max_duration)
+
+
+def group_identity_segments(
+        identity_segments: dict[str, np.ndarray],
+        max_duration: int | None = None
+    ) -> list[tuple[int, int, list[str]]]:
+    """
+    Cut segments of different identities into (start, end, labels) ranges. Where segments of several
+    identities overlap, the range is split at every segment start and end, so that each part is cut once
+    and saved only for the identities whose own segments cover it. Adjacent parts shared by the same
+    identities are joined.
+
+    Args:
+        identity_segments (dict[str, np.ndarray]): (K, 2) array of (start, end) segments of each identity
+        max_duration (int | None): maximum number of frames of a range, None for no limit
+
+    Returns:
+        list[tuple[int, int, list[str]]]: sorted list of (start, end) frame indices with the identities they contain
+    """
+    labels = list(identity_segments)
+    segments_list = [merge_segments(segments) for segments in identity_segments.values()]
+    segments = np.concatenate([np.empty((0, 2), dtype=np.int64)] + segments_list)
+    if len(segments) == 0:
+        return []
+
+    # elementary parts between consecutive segment bounds, and the identities covering each of them
+    bounds = np.unique(segments)
+    part_starts = bounds[:-1]
+    coverage = np.zeros((len(labels), len(part_starts)), dtype=bool)
+    for label_index, label_segments in enumerate(segments_list):
+        if len(label_segments) == 0:
+            continue
+        # segments of one identity are sorted and disjoint: a part is covered by the last segment starting before it
+        containing = np.searchsorted(label_segments[:, 0], part_starts, side="right") - 1
+        coverage[label_index] = (containing >= 0) & (part_starts < label_segments[containing, 1])
+
+    # join adjacent parts covered by the same identities, drop parts covered by none
+    covered = coverage.any(axis=0)
+    changed = np.r_[True, (coverage[:, 1:] != coverage[:, :-1]).any(axis=0)]
+    first = np.flatnonzero(covered & changed)
+    last = np.r_[first[1:], len(part_starts)]
+
+    identity_ranges = []
+    for first_part, last_part in zip(first.tolist(), last.tolist()):
+        # a run of parts ends at the next change of identities or at the first uncovered part
+        uncovered = np.flatnonzero(~covered[first_part:last_part])
+        if len(uncovered):
+            last_part = first_part + uncovered[0]
+        start, end = int(bounds[first_part]), int(bounds[last_part])
+        range_labels = [labels[i] for i in np.flatnonzero(coverage[:, first_part]).tolist()]
+        parts = split_segments([(start, end)], max_duration).tolist() if max_duration is not None else [(start, end)]
+        identity_ranges.extend((part_start, part_end, range_labels) for part_start, part_end in parts)
+
+    return identity_ranges
+
+
+def save_clip(video_path: Path, start: int, end: int, output_dirs: list[Path]) -> Path:
+    """
+    Cut a clip once and save it in every output directory. Copies after the first one are links.
+
+    Args:
+        video_path (Path): path to original video
+        start (int): index of first frame
+        end (int): index of last frame
+        output_dirs (list[Path]): directories where to save the clip
+
+    Returns:
+        Path: path of the encoded clip
+    """
+    video_clip = extract_video(video_path, start=start, end=end)
+    # frame range keeps names unique when clips are written in parallel
+    filename = f"{get_datetime()}_{start}-{end}.MP4"
+    output_path = Path(output_dirs[0]) / filename
+    save_video(video_clip, output_path)
+    for output_dir in output_dirs[1:]:
+        link_file(output_path, Path(output_dir) / filename)
+    return output_path
+
+
+class ClipWriter():
+    """
+    Write clips in background processes while the video is still being scanned.
+
+    Detections are pushed in increasing frame order. A segment is written as soon as the scan moved
+    far enough past its last detection that no later detection can extend it (see SegmentStream).
+    With per_identity, a segment also waits until no other identity can still produce an overlapping
+    segment, so that shared parts are cut once and linked, as in process_identity_frames.
+    """
+
+    def __init__(
+            self,
+            video_path: Path,
+            output_dir: Path,
+            clips_length: int = 1800,
+            per_identity: bool = False,
+            workers: int = 2,
+            pre_pad: int | None = None,
+            post_pad: int | None = None,
+            max_duration: int | None = None,
+            **segment_options
+        ):
+        self.video_path = video_path
+        self.output_dir = Path(output_dir)
+        self.per_identity = per_identity
+        self.max_duration = max_duration
+        self.stream_options = {
+            "pre_pad": clips_length // 3 if pre_pad is None else pre_pad,
+            "post_pad": 2 * clips_length // 3 if post_pad is None else post_pad,
+            "video_length": int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT)),
+            **segment_options,
+        }
+        self.streams: dict[str | None, SegmentStream] = {}
+        # closed segments of each identity not grouped yet
+        self.pending: dict[str | None, list[np.ndarray]] = {}
+        # while profiling, workers return the time of timed functions to the parent, and are spawned
+        # rather than forked from a process running the stack sampler thread
+        self.profiling = timers_enabled()
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn") if self.profiling else None
+        )
+        self.futures = []
+
+    def push(self, frame_index: int, labels: set[str]) -> None:
+        """Add the identities detected at frame_index"""
+        for label in (labels if self.per_identity else [None]):
+            if label not in self.streams:
+                self.streams[label] = SegmentStream(**self.stream_options)
+                self.streams[label].advance(frame_index)
+                self.pending[label] = []
+                if label is not None:
+                    (self.output_dir / label).mkdir(exist_ok=True)
+            self.streams[label].push(frame_index)
+
+    def advance(self, position: int) -> None:
+        """Declare that every frame before position was scanned, and submit clips that are now closed"""
+        for label, stream in self.streams.items():
+            segments = stream.advance(position)
+            if len(segments):
+                self.pending[label].append(segments)
+        # no stream, including identities not detected yet, can start a new segment before horizon
+        horizon = min(
+            [stream.horizon for stream in self.streams.values()] + [position - self.stream_options["pre_pad"]]
+        )
+        self._submit(horizon)
+
+    def close(self) -> int:
+        """
+        Submit remaining clips and wait for all of them to be written
+
+        Returns:
+            int: number of written clips
+        """
+        for label, stream in self.streams.items():
+            self.pending[label].append(stream.flush())
+        self._submit(None)
+        self.executor.shutdown()
+        for future in self.futures:
+            result = future.result()
+            if self.profiling:
+                add_timers(result[1])
+        logger.info(f"Saved {len(self.futures)} clips to {self.output_dir}")
+        return len(self.futures)
+
+    def _submit(self, horizon: int | None) -> None:
+        """Submit grouped ranges that end before horizon, all of them if horizon is None"""
+        pending_segments = {
+            label: np.concatenate([np.empty((0, 2), dtype=np.int64)] + pending)
+            for label, pending in self.pending.items()
+        }
+        identity_ranges = group_identity_segments(pending_segments)
+        if horizon is not None:
+            # only submit whole groups of overlapping segments: ranges of a group that ends past horizon
+            # can still be split by a segment not closed yet
+            groups = merge_segments(np.concatenate(list(pending_segments.values()) + [np.empty((0, 2), dtype=np.int64)]))
+            closed_groups = groups[groups[:, 1] < horizon]
+            closed_end = closed_groups[-1, 1] if len(closed_groups) else -1
+            identity_ranges = [identity_range for identity_range in identity_ranges if identity_range[1] <= closed_end]
+        if not identity_ranges:
+            return
+
+        submitted_end = identity_ranges[-1][1]
+        for label, segments in pending_segments.items():
+            self.pending[label] = [segments[segments[:, 0] > submitted_end]]
+
+        for start, end, labels in identity_ranges:
+            parts = [(start, end)]
+            if self.max_duration is not None:
+                parts = split_segments(parts, self.max_duration).tolist()
+            output_dirs = [self.output_dir if label is None else self.output_dir / label for label in labels]
+            for part_start, part_end in parts:
+                logger.debug(f"Submitting clip of frames {part_start}-{part_end} for {labels}")
+                task = (save_clip, self.video_path, part_start, part_end, output_dirs)
+                if self.profiling:
+                    task = (run_timed,) + task
+                self.futures.append(self.executor.submit(*task))
 
 
-def process_extracted_frames(video_path: Path, frames: list[set[int]], output_dir: Path, clips_length: int = 1800) -> None:
+def process_identity_frames(
+        video_path: Path,
+        identity_frames: dict[str, list[set[int]] | set[int]],
+        output_dir: Path,
+        clips_length: int = 1800,
+        **segment_options
+    ) -> None:
+    """
+    Given frames detected for each identity, extract subclips of original video in {output_dir}/{label}
+
+    Args:
+        video_path (Path): path to original video
+        identity_frames (dict[str, list[set[int]] | set[int]]): detected frames of each identity
+        output_dir (Path): directory where to save subclips
+        clips_length (int): number of frames per extracted subclips
+        segment_options: keyword arguments of get_frame_ranges (padding, gap, duration limits)
+
+    Returns:
+        None
+    """
+    logger.info(f"Starting per identity post processing for video {video_path.stem}")
+
+    video_length = int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT))
+    identity_ranges = get_identity_frame_ranges(identity_frames, clips_length, video_length, **segment_options)
+    for label in identity_frames:
+        (Path(output_dir) / label).mkdir(exist_ok=True)
+
+    count = 0
+    shared = 0
+    logger.info(f"Saving extracted clips of {len(identity_frames)} identities to {output_dir}")
+    for start, end, labels in identity_ranges:
+        save_clip(video_path, start, end, [Path(output_dir) / label for label in labels])
+        count += 1
+        shared += len(labels) > 1
+    logger.info(f"Saved {count} clips, {shared} of them shared by more than one identity")
+
+
+def process_extracted_frames(
+        video_path: Path,
+        frames: list[set[int]] | set[int] | dict[str, list[set[int]] | set[int]],
+        output_dir: Path,
+        clips_length: int = 1800,
+        **segment_options
+    ) -> None:
     """
     Given detected frames, extract subclips of original video
 
     Args:
         video_path (Path): path to original video
-        frames (list[set[int]]): set of detected frames
+        frames (list[set[int]] | set[int] | dict[str, list[set[int]] | set[int]]): set of detected frames.
+            If a dict of frames per identity is given, clips are saved per identity (see process_identity_frames)
         output_dir (Path): directory where to save subclips
         clips_length (int): number of frames per extracted subclips
+        segment_options: keyword arguments of get_frame_ranges (padding, gap, duration limits)
     
     Returns:
         None
     """
+    if isinstance(frames, dict):
+        process_identity_frames(video_path, frames, output_dir, clips_length=clips_length, **segment_options)
+        return
+
     logger.info(f"Starting post processing for video {video_path.stem}")
 
-    video_length = cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT)
-    frame_ranges = get_frame_ranges(frames, clips_length, video_length)
+    video_length = int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_ranges = get_frame_ranges(frames, clips_length, video_length, **segment_options)
     count = 0
     logger.info(f"Saving extracted clips to {output_dir}")
     for range in frame_ranges:
-        video_clip = extract_video(video_path, start=range[0], end=range[1])
-        output_path = Path(output_dir) / f"{get_datetime()}.MP4"
-        save_video(video_clip, output_path)
+        save_clip(video_path, range[0], range[1], [output_dir])
         count+= 1
     logger.info(f"Saved {count} clips")
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""Pick sampling interval, batch size and detection scale from a short dry run"""
+import logging
+import math
+import time
+from pathlib import Path
+
+import numpy as np
+
+from ai.face_recognizer import FaceDetector
+from etl.extract import probe_video, sample_frames, time_decode
+
+logger = logging.getLogger()
+
+CANDIDATE_SCALES = (1.0, 0.75, 0.5, 0.25)
+# frames decoded to measure decode time
+DECODE_SAMPLE_SIZE = 50
+
+
+def time_detection(face_detector: FaceDetector, frames: list[np.ndarray]) -> tuple[float, int]:
+    """
+    Run face detection on sample frames
+
+    Args:
+        face_detector (FaceDetector): detector configured with the scale to measure
+        frames (list[np.ndarray]): sample frames
+
+    Returns:
+        tuple[float, int]: average time in seconds to detect faces in one frame, number of faces found
+    """
+    faces_found = 0
+    start = time.perf_counter()
+    for frame in frames:
+        faces_found += len(face_detector.detect_faces(frame))
+    elapsed = time.perf_counter() - start
+    return elapsed / max(len(frames), 1), faces_found
+
+
+def plan_settings(
+        video_path: Path,
+        time_resolution: float = 0.5,
+        memory_budget: int = 2048,
+        sample_size: int = 20
+    ) -> dict:
+    """
+    Probe video, time decode and detection on a sample of frames, and pick the fastest
+    configuration that meets the time resolution and memory budget.
+
+    Frame interval is the largest one that samples at least one frame every time_resolution seconds.
+    Detection scale is the smallest one that finds as many faces as full resolution on the sample,
+    full resolution if the sample has no face.
+    Batch size is the largest one whose frames fit in memory_budget.
+
+    Args:
+        video_path (Path): path to video to analyze
+        time_resolution (float): maximum number of seconds between two analyzed frames
+        memory_budget (int): maximum memory in MB used by decoded frames
+        sample_size (int): number of frames used to time detection
+
+    Returns:
+        dict: frame_interval, batch_size, scale, fits_in_memory (whether run mode fits in the budget),
+            estimated_seconds and peak_memory_mb
+    """
+    video_info = probe_video(video_path)
+    fps = video_info["fps"] or 30
+    total_frames = video_info["total_frames"]
+    logger.info(
+        f"Video {video_info['width']}x{video_info['height']} {video_info['codec']} "
+        f"at {fps:.2f} fps, {total_frames} frames"
+    )
+
+    frame_interval = max(int(time_resolution * fps), 1)
+    sampled_frames = math.ceil(total_frames / frame_interval)
+    logger.info(
+        f"Frame interval {frame_interval}: one frame every {frame_interval / fps:.2f}s "
+        f"meets time resolution {time_resolution}s, {sampled_frames} frames to analyze"
+    )
+
+    decode_time = time_decode(video_path, DECODE_SAMPLE_SIZE, start_frame=total_frames // 2)
+    logger.info(f"Decode takes {decode_time * 1000:.1f}ms per frame")
+
+    frames = sample_frames(video_path, sample_size, total_frames)
+    scale = 1.0
+    detect_time = None
+    reference_faces = None
+    for candidate_scale in CANDIDATE_SCALES:
+        candidate_time, faces_found = time_detection(FaceDetector(scale=candidate_scale), frames)
+        estimate = total_frames * decode_time + sampled_frames * candidate_time
+        if reference_faces is None:
+            reference_faces = faces_found
+        accepted = faces_found >= reference_faces
+        logger.info(
+            f"Scale {candidate_scale}: {candidate_time * 1000:.1f}ms per frame, {faces_found}/{reference_faces} "
+            f"sample faces found, estimated runtime {estimate:.0f}s - {'accepted' if accepted else 'rejected'}"
+        )
+        if accepted and (detect_time is None or candidate_time < detect_time):
+            scale, detect_time = candidate_scale, candidate_time
+        if reference_faces == 0:
+            # nothing to compare smaller scales against, they could miss every face of the video
+            logger.warning(f"No face found in the {len(frames)} sample frames, keeping full resolution")
+            break
+
+    frame_mb = video_info["width"] * video_info["height"] * 3 / 2**20
+    batch_size = min(max(int(memory_budget / frame_mb), 1), total_frames)
+    fits_in_memory = total_frames * frame_mb <= memory_budget
+    logger.info(
+        f"Frames take {frame_mb:.1f}MB each: run mode needs {total_frames * frame_mb:.0f}MB "
+        f"({'within' if fits_in_memory else 'over'} budget of {memory_budget}MB), "
+        f"batch mode fits {batch_size} frames per batch"
+    )
+
+    plan = {
+        "frame_interval": frame_interval,
+        "batch_size": batch_size,
+        "scale": scale,
+        "fits_in_memory": fits_in_memory,
+        "estimated_seconds": total_frames * decode_time + sampled_frames * detect_time,
+        "peak_memory_mb": min(batch_size * frame_mb, total_frames * frame_mb),
+    }
+    logger.info(
+        f"Selected frame interval {frame_interval}, batch size {batch_size}, scale {scale}: "
+        f"estimated runtime {plan['estimated_seconds']:.0f}s, peak frames memory {plan['peak_memory_mb']:.0f}MB"
+    )
+    return plan
@@ -0,0 +1,146 @@
+"""Split the scan of a video across nodes, and merge their detections files"""
+import logging
+
+logger = logging.getLogger()
+
+DETECTIONS_FORMAT = "clip-extractor-detections"
+DETECTIONS_VERSION = 1
+# settings that must be identical across shards of the same video
+SHARED_SETTINGS = (
+    "frame_interval",
+    "detection_scale",
+    "early_exit",
+    "min_face_size",
+    "region",
+    "per_identity",
+    "model_version",
+    "known_faces",
+)
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """
+    Parse a shard specification
+
+    Args:
+        shard (str): "i/N", shard i (starting from 0) of N
+
+    Returns:
+        tuple[int, int]: shard index, shard count
+    """
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    except ValueError as e:
+        raise ValueError(f"Shard must be formatted as i/N - found: {shard}") from e
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in [0, {count}) - found: {shard}")
+    return index, count
+
+
+def shard_bounds(total_frames: int, index: int, count: int, frame_interval: int) -> tuple[int, int]:
+    """
+    Returns the [start, end) frame range of a shard. Bounds are aligned on the sampling grid, so that every
+    frame analyzed by a full scan (global index multiple of frame_interval) is analyzed by exactly one shard
+
+    Args:
+        total_frames (int): total number of frames in the video
+        index (int): shard index, starting from 0
+        count (int): number of shards
+        frame_interval (int): frame interval to process
+
+    Returns:
+        tuple[int, int]: first frame of the shard, first frame after the shard
+    """
+    def bound(i: int) -> int:
+        if i == count:
+            return total_frames
+        return total_frames * i // count // frame_interval * frame_interval
+
+    return bound(index), bound(index + 1)
+
+
+def build_detections(
+        video: dict,
+        settings: dict,
+        shard: dict,
+        run: dict,
+        identity_frames: dict[str, list[int]]
+    ) -> dict:
+    """
+    Build the portable content of a detections file
+
+    Args:
+        video (dict): name, fingerprint, total_frames and fps of the scanned video
+        settings (dict): detection settings, see SHARED_SETTINGS
+        shard (dict): index, count, start and end frame of the shard
+        run (dict): host, start and end time of the scan
+        identity_frames (dict[str, list[int]]): global indices of frames where each identity was detected
+
+    Returns:
+        dict: detections, ready to be saved as json
+    """
+    return {
+        "format": DETECTIONS_FORMAT,
+        "version": DETECTIONS_VERSION,
+        "video": video,
+        "settings": settings,
+        "shard": shard,
+        "run": run,
+        "detections": {label: sorted(frames) for label, frames in identity_frames.items()},
+    }
+
+
+def merge_detections(detections_list: list[dict]) -> tuple[dict[str, set[int]], dict]:
+    """
+    Check that detections files are the complete and consistent set of shards of one scan, and combine them
+
+    Args:
+        detections_list (list[dict]): content of the detections file of every shard
+
+    Returns:
+        tuple[dict[str, set[int]], dict]: frames where each identity was detected in the whole video,
+            detections of the first shard (video and settings metadata)
+    """
+    if not detections_list:
+        raise ValueError("No detections file to merge")
+
+    for detections in detections_list:
+        if detections.get("format") != DETECTIONS_FORMAT or detections.get("version") != DETECTIONS_VERSION:
+            raise ValueError(
+                f"Unsupported detections file {detections.get('format')} version {detections.get('version')}"
+            )
+
+    reference = detections_list[0]
+    for detections in detections_list[1:]:
+        if detections["video"]["fingerprint"] != reference["video"]["fingerprint"]:
+            raise ValueError(
+                f"Shards come from different videos: {reference['video']['name']} and {detections['video']['name']}"
+            )
+        for setting in SHARED_SETTINGS:
+            if detections["settings"][setting] != reference["settings"][setting]:
+                raise ValueError(
+                    f"Shards were scanned with different {setting}: "
+                    f"{reference['settings'][setting]} and {detections['settings'][setting]}"
+                )
+
+    # shards must tile the video without gap nor overlap
+    shards = sorted(detections_list, key=lambda detections: detections["shard"]["start"])
+    expected_start = 0
+    for detections in shards:
+        shard = detections["shard"]
+        if shard["start"] != expected_start:
+            kind = "Missing" if shard["start"] > expected_start else "Overlapping"
+            raise ValueError(f"{kind} frames between {expected_start} and {shard['start']}")
+        expected_start = shard["end"]
+    if expected_start != reference["video"]["total_frames"]:
+        raise ValueError(f"Missing frames between {expected_start} and {reference['video']['total_frames']}")
+
+    identity_frames = {}
+    for detections in shards:
+        for label, frames in detections["detections"].items():
+            identity_frames.setdefault(label, set()).update(frames)
+    logger.info(
+        f"Merged {len(shards)} shards of {reference['video']['name']}: "
+        f"{sum(len(frames) for frames in identity_frames.values())} detections of {len(identity_frames)} identities"
+    )
+    return identity_frames, reference
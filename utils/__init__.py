@@ -1,3 +1,4 @@
 from utils.process import *
 from utils.log import *
-from utils.io import *
\ No newline at end of file
+from utils.io import *
+from utils.profiling import *
\ No newline at end of file
@@ -1,18 +1,259 @@
 """Contains functions used for io operations - read from files, write to files, etc"""
 
+import contextlib
+import hashlib
+import json
 import logging
+import os
+import shutil
+import struct
+import time
 from pathlib import Path
+from typing import TYPE_CHECKING
 import numpy as np
 
-from moviepy.video.io.VideoFileClip import VideoClip
+from utils.profiling import timed
+
+if TYPE_CHECKING:
+    from moviepy.video.io.VideoFileClip import VideoClip
 
 logger = logging.getLogger()
 
-def load_encodings(encodings_file_path: Path) -> list[np.ndarray]:
+GALLERY_EXT = ".gallery"
+GALLERY_MAGIC = b"CXGALLRY"
+GALLERY_FORMAT_VERSION = 1
+# magic, format version, model version, padded to 64 bytes
+GALLERY_HEADER = struct.Struct("<8sH54s")
+# one fixed size record per encoding: records are appended after the header, never rewritten
+GALLERY_RECORD = np.dtype([
+    ("encoding", "<f4", (128,)),
+    ("label", "S64"),
+    ("source_hash", "S64"),
+])
+# seconds to wait for another process appending to the same gallery
+GALLERY_LOCK_TIMEOUT = 60
+
+
+class Gallery():
+    """Face encodings gallery memory-mapped from a .gallery file"""
+
+    def __init__(self, records: np.ndarray, model_version: str):
+        self.records = records
+        self.model_version = model_version
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def encodings(self) -> np.ndarray:
+        """(N, 128) float32 face encodings"""
+        return self.records["encoding"]
+
+    @property
+    def labels(self) -> np.ndarray:
+        """(N,) identity labels stored as utf-8 bytes"""
+        return self.records["label"]
+
+    @property
+    def source_hashes(self) -> np.ndarray:
+        """(N,) sha256 hex digests of the source images, empty if unknown"""
+        return self.records["source_hash"]
+
+
+def hash_file(file_path: Path) -> str:
+    """Returns sha256 hex digest of a file"""
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def fingerprint_file(file_path: Path, chunk_size: int = 2**20) -> str:
+    """
+    Returns a quick sha256 fingerprint of a large file, computed from its size and its first and last chunk
+    """
+    file_size = os.path.getsize(file_path)
+    digest = hashlib.sha256(str(file_size).encode())
+    with open(file_path, "rb") as f:
+        digest.update(f.read(chunk_size))
+        f.seek(max(file_size - chunk_size, 0))
+        digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+def _read_gallery_header(gallery_path: Path) -> str:
+    """Validate gallery header and return the model version"""
+    with open(gallery_path, "rb") as f:
+        header = f.read(GALLERY_HEADER.size)
+    if len(header) < GALLERY_HEADER.size:
+        raise ValueError(f"{gallery_path} is not a gallery file: header is truncated")
+    magic, format_version, model_version = GALLERY_HEADER.unpack(header)
+    if magic != GALLERY_MAGIC:
+        raise ValueError(f"{gallery_path} is not a gallery file")
+    if format_version != GALLERY_FORMAT_VERSION:
+        raise ValueError(f"Unsupported gallery format version {format_version} in {gallery_path}")
+    return model_version.rstrip(b"\0").decode()
+
+
+def load_gallery(gallery_path: Path) -> Gallery:
+    """
+    Memory-map a gallery file. Only the header is read, encodings are paged in when used.
+
+    Args:
+        gallery_path (Path): path to .gallery file
+
+    Returns:
+        Gallery: read-only view of the gallery records
+    """
+    logger.info(f"Reading gallery from {gallery_path}")
+    model_version = _read_gallery_header(gallery_path)
+    records_size = os.path.getsize(gallery_path) - GALLERY_HEADER.size
+    count = records_size // GALLERY_RECORD.itemsize
+    if records_size % GALLERY_RECORD.itemsize:
+        logger.warning(f"Ignoring truncated record at the end of {gallery_path}")
+
+    if count == 0:
+        records = np.zeros(0, dtype=GALLERY_RECORD)
+    else:
+        records = np.memmap(
+            gallery_path, dtype=GALLERY_RECORD, mode="r", offset=GALLERY_HEADER.size, shape=(count,)
+        )
+    logger.debug(f"Mapped {count} encodings from {gallery_path}")
+    return Gallery(records, model_version)
+
+
+def append_to_gallery(
+        gallery_path: Path,
+        encodings: np.ndarray,
+        labels: list[str] | np.ndarray,
+        source_hashes: list[str] | np.ndarray,
+        model_version: str
+    ) -> int:
+    """
+    Append encodings to a gallery file, creating it if needed. Existing records are never rewritten.
+
+    Args:
+        gallery_path (Path): path to .gallery file
+        encodings (np.ndarray): (N, 128) face encodings
+        labels (list[str] | np.ndarray): identity label of each encoding
+        source_hashes (list[str] | np.ndarray): hash of the source image of each encoding, empty if unknown
+        model_version (str): version of the model that produced the encodings
+
+    Returns:
+        int: number of appended encodings
+    """
+    encodings = np.asarray(encodings).reshape(-1, 128)
+    records = np.zeros(len(encodings), dtype=GALLERY_RECORD)
+    records["encoding"] = encodings
+    records["label"] = [to_gallery_bytes(label, "label") for label in labels]
+    records["source_hash"] = [to_gallery_bytes(source_hash, "source_hash") for source_hash in source_hashes]
+
+    # writers hold the lock from creation or validation to the end of the append, so that a truncated
+    # record can only be left by an interrupted writer, never by one still appending
+    with _gallery_lock(gallery_path):
+        if not Path(gallery_path).exists():
+            with open(gallery_path, "xb") as f:
+                f.write(GALLERY_HEADER.pack(GALLERY_MAGIC, GALLERY_FORMAT_VERSION, model_version.encode()))
+            logger.info(f"Created gallery {gallery_path}")
+        else:
+            gallery_model_version = _read_gallery_header(gallery_path)
+            if gallery_model_version != model_version:
+                raise ValueError(
+                    f"Cannot append encodings of model {model_version} to gallery of model {gallery_model_version}"
+                )
+            records_size = os.path.getsize(gallery_path) - GALLERY_HEADER.size
+            if records_size % GALLERY_RECORD.itemsize:
+                # drop a record left truncated by an interrupted append
+                os.truncate(gallery_path, os.path.getsize(gallery_path) - records_size % GALLERY_RECORD.itemsize)
+
+        with open(gallery_path, "ab") as f:
+            f.write(records.tobytes())
+    logger.debug(f"Appended {len(records)} encodings to {gallery_path}")
+    return len(records)
+
+
+@contextlib.contextmanager
+def _gallery_lock(gallery_path: Path, timeout: float = GALLERY_LOCK_TIMEOUT):
+    """Hold an exclusive {gallery}.lock file, created with O_EXCL so that it also works on network filesystems"""
+    lock_path = f"{gallery_path}.lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"Gallery {gallery_path} is locked by another process. "
+                    f"If no other process is writing to it, remove {lock_path}"
+                )
+            time.sleep(0.1)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(str(os.getpid()))
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def to_gallery_bytes(value: str | bytes, field: str) -> bytes:
+    """Encode a string for a field of GALLERY_RECORD, raising instead of truncating a value that does not fit"""
+    value = value.encode() if isinstance(value, str) else bytes(value)
+    size = GALLERY_RECORD[field].itemsize
+    if len(value) > size:
+        raise ValueError(f"Gallery {field} {value!r} is longer than {size} bytes")
+    return value
+
+
+def migrate_encodings(
+        encodings_path: Path,
+        gallery_path: Path,
+        model_version: str,
+        label: str,
+        allow_pickle: bool = False
+    ) -> int:
+    """
+    Convert legacy encodings, a .npy file or a directory of {label}.npy files, to a gallery file
+
+    Args:
+        encodings_path (Path): legacy .npy file or directory
+        gallery_path (Path): output .gallery file, appended to if it exists
+        model_version (str): version of the model that produced the encodings
+        label (str): identity label of the encodings of a single .npy file
+        allow_pickle (bool): read ragged lists saved as object arrays, only for trusted files (see load_encodings)
+
+    Returns:
+        int: number of migrated encodings
+    """
+    if Path(encodings_path).is_dir():
+        labelled_encodings = load_labelled_encodings(encodings_path, allow_pickle=allow_pickle)
+    else:
+        labelled_encodings = {label: load_encodings(encodings_path, allow_pickle=allow_pickle)}
+
+    count = 0
+    for label, encodings in labelled_encodings.items():
+        count += append_to_gallery(gallery_path, encodings, [label] * len(encodings), [""] * len(encodings), model_version)
+    logger.info(f"Migrated {count} encodings from {encodings_path} to {gallery_path}")
+    return count
+
+
+def load_encodings(encodings_file_path: Path, allow_pickle: bool = False) -> np.ndarray:
+    """
+    Load face encodings from a legacy .npy file
+
+    Args:
+        encodings_file_path (Path): .npy file
+        allow_pickle (bool): also read ragged lists saved as object arrays by older versions, and flatten them.
+            Object arrays are unpickled, which can run arbitrary code: only use on trusted files
+
+    Returns:
+        np.ndarray: (N, 128) face encodings
+    """
     logger.info(f"Reading encodings from {encodings_file_path}")
     with open(encodings_file_path, "rb") as f:
-        known_face_encodings = np.load(f)
-    return known_face_encodings
+        known_face_encodings = np.load(f, allow_pickle=allow_pickle)
+    if known_face_encodings.dtype == object:
+        known_face_encodings = [np.asarray(encodings, dtype=np.float64).reshape(-1, 128) for encodings in known_face_encodings]
+        return np.concatenate(known_face_encodings) if known_face_encodings else np.empty((0, 128))
+    return known_face_encodings.reshape(-1, 128)
 
 def save_encodings(encodings: list[np.ndarray], file_path: Path) -> None:
     """
@@ -25,6 +266,55 @@ def save_encodings(encodings: list[np.ndarray], file_path: Path) -> None:
     np.save(file_path, encodings)
     logger.debug(f"Saved encodings to {file_path}")
 
+def load_labelled_encodings(encodings_dir: Path, allow_pickle: bool = False) -> dict[str, np.ndarray]:
+    """
+    Load one .npy encodings file per identity from a directory. The identity label is the file stem.
+
+    Args:
+        encodings_dir (Path): directory containing {label}.npy files
+        allow_pickle (bool): read object arrays, only for trusted files (see load_encodings)
+
+    Returns:
+        dict[str, np.ndarray]: face encodings of each identity
+    """
+    logger.info(f"Reading labelled encodings from {encodings_dir}")
+    labelled_encodings = {}
+    for encodings_file_path in sorted(Path(encodings_dir).glob("*.npy")):
+        labelled_encodings[encodings_file_path.stem] = load_encodings(encodings_file_path, allow_pickle=allow_pickle)
+    return labelled_encodings
+
+def save_labelled_encodings(labelled_encodings: dict[str, np.ndarray], encodings_dir: Path) -> None:
+    """
+    Saves face encodings of each identity to its own {label}.npy file.
+
+    Args:
+        labelled_encodings (dict[str, np.ndarray]): face encodings of each identity
+        encodings_dir (Path): output directory
+    """
+    for label, encodings in labelled_encodings.items():
+        save_encodings(encodings, Path(encodings_dir) / f"{label}.npy")
+
+def link_file(source_path: Path, link_path: Path) -> None:
+    """Hard link source to link path, fall back to a copy if the filesystem does not support it"""
+    try:
+        os.link(source_path, link_path)
+    except OSError:
+        shutil.copy2(source_path, link_path)
+    logger.debug(f"Linked {source_path} to {link_path}")
+
+def save_json(data: dict, filepath: Path) -> None:
+    """Save dict as json. The file is written next to filepath and renamed, so readers never see a partial file"""
+    tmp_path = Path(f"{filepath}.tmp")
+    with open(tmp_path, "wt", encoding="UTF8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, filepath)
+    logger.debug(f"Saved JSON {filepath}")
+
+def load_json(filepath: Path) -> dict:
+    """Load json as dict"""
+    with open(filepath, "rt", encoding="UTF8") as f:
+        return json.load(f)
+
 def save_txt(txt: str, filepath: Path, encoding: str = "UTF8") -> None:
     """Save string as txt"""
     with open(filepath, "wt", encoding=encoding) as f:
@@ -32,7 +322,8 @@ def save_txt(txt: str, filepath: Path, encoding: str = "UTF8") -> None:
     logger.debug(f"Saved TXT {filepath}")
 
 
-def save_video(video_clip: VideoClip, video_path: Path) -> None:
+@timed
+def save_video(video_clip: "VideoClip", video_path: Path) -> None:
     """Save video to path"""
     video_path = str(video_path)
     video_clip.write_videofile(video_path, codec="libx264", logger=None)
@@ -6,6 +6,7 @@ import logging
 from datetime import datetime
 from pathlib import Path
 import click
+import numpy as np
 
 
 logger = logging.getLogger()
@@ -29,6 +30,214 @@ def is_image_file(filepath: Path):
     return filepath.suffix in valid_extensions
 
 
+def frames_to_array(frames: list[set[int]] | set[int] | np.ndarray) -> np.ndarray:
+    """
+    Convert detected frame indices to a sorted array of unique int64 frame indices
+
+    Args:
+        frames (list[set[int]] | set[int] | np.ndarray): list of sets, single set or array of frame indices
+
+    Returns:
+        np.ndarray: sorted unique frame indices
+    """
+    if isinstance(frames, np.ndarray):
+        hits = frames.astype(np.int64, copy=False).ravel()
+    elif isinstance(frames, list):
+        hits = np.concatenate(
+            [np.empty(0, dtype=np.int64)] + [np.fromiter(f, dtype=np.int64, count=len(f)) for f in frames]
+        )
+    else:
+        hits = np.fromiter(frames, dtype=np.int64, count=len(frames))
+
+    # detections usually come sorted, skip the sort in that case
+    if np.any(hits[1:] < hits[:-1]):
+        hits = np.sort(hits)
+    return hits[np.r_[True, hits[1:] != hits[:-1]]] if len(hits) else hits
+
+
+def merge_segments(segments: np.ndarray) -> np.ndarray:
+    """
+    Merges overlapping or contiguous (start, end) segments, vectorized version of merge_overlapping_ranges
+
+    Args:
+        segments (np.ndarray): (K, 2) array of (start, end) segments, in any order
+
+    Returns:
+        np.ndarray: (M, 2) array of sorted non-overlapping segments
+    """
+    segments = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+    if len(segments) == 0:
+        return segments
+    segments = segments[np.argsort(segments[:, 0], kind="stable")]
+    ends = np.maximum.accumulate(segments[:, 1])
+    # a new segment starts where start is past the end of all previous segments
+    new_group = np.flatnonzero(segments[1:, 0] > ends[:-1]) + 1
+    first = np.r_[0, new_group]
+    last = np.r_[new_group - 1, len(segments) - 1]
+    return np.stack([segments[first, 0], ends[last]], axis=1)
+
+
+def split_segments(segments: np.ndarray, max_duration: int) -> np.ndarray:
+    """
+    Split segments longer than max_duration into the fewest equal parts no longer than max_duration
+
+    Args:
+        segments (np.ndarray): (K, 2) array of (start, end) segments
+        max_duration (int): maximum number of frames per segment
+
+    Returns:
+        np.ndarray: (M, 2) array of segments
+    """
+    if max_duration <= 0:
+        raise ValueError(f"max_duration must be positive - found: {max_duration}")
+    segments = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+    durations = segments[:, 1] - segments[:, 0]
+    parts = np.maximum(-(-durations // max_duration), 1)
+    # index of each part within its segment
+    part_index = np.arange(parts.sum()) - np.repeat(np.cumsum(parts) - parts, parts)
+    starts = np.repeat(segments[:, 0], parts)
+    durations = np.repeat(durations, parts)
+    parts = np.repeat(parts, parts)
+    return np.stack([
+        starts + part_index * durations // parts,
+        starts + (part_index + 1) * durations // parts,
+    ], axis=1)
+
+
+def get_segments(
+        frames: list[set[int]] | set[int] | np.ndarray,
+        pre_pad: int,
+        post_pad: int,
+        video_length: int,
+        max_gap: int = 0,
+        min_hits: int = 1,
+        min_duration: int = 0,
+        max_duration: int | None = None
+    ) -> np.ndarray:
+    """
+    Turn frames where a face was detected into (start, end) segments to extract.
+
+    Detections closer than max_gap frames are bridged into a single run. A run opens a segment
+    only if it has at least min_hits detections (hysteresis: isolated false positives are dropped,
+    while a confirmed run survives gaps up to max_gap). Each run is padded by pre_pad and post_pad
+    frames, overlapping segments are merged, segments shorter than min_duration are dropped and
+    segments longer than max_duration are split.
+
+    Args:
+        frames (list[set[int]] | set[int] | np.ndarray): detected frame indices
+        pre_pad (int): frames kept before the first detection of a run
+        post_pad (int): frames kept after the last detection of a run
+        video_length (int): total number of frames of input video
+        max_gap (int): maximum number of frames between two detections of the same run
+        min_hits (int): minimum number of detections of a run
+        min_duration (int): minimum number of frames of a segment
+        max_duration (int | None): maximum number of frames of a segment, None for no limit
+
+    Returns:
+        np.ndarray: (K, 2) array of sorted non-overlapping (start, end) frame indices
+
+    Example:
+        >>> get_segments({10, 12, 50}, pre_pad=2, post_pad=3, video_length=100, max_gap=5).tolist()
+        [[8, 15], [48, 53]]
+    """
+    hits = frames_to_array(frames)
+    if len(hits) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    breaks = np.flatnonzero(np.diff(hits) > max_gap) + 1
+    run_first = hits[np.r_[0, breaks]]
+    run_last = hits[np.r_[breaks - 1, len(hits) - 1]]
+    run_hits = np.diff(np.r_[0, breaks, len(hits)])
+    confirmed = run_hits >= min_hits
+
+    segments = np.stack([
+        np.maximum(run_first[confirmed] - pre_pad, 0),
+        np.minimum(run_last[confirmed] + post_pad, int(video_length)),
+    ], axis=1)
+    segments = merge_segments(segments)
+    segments = segments[segments[:, 1] - segments[:, 0] >= min_duration]
+    if max_duration is not None:
+        segments = split_segments(segments, max_duration)
+
+    return segments
+
+
+class SegmentStream():
+    """
+    Incremental version of get_segments for detections that arrive in increasing frame order.
+
+    Detections are buffered until no future detection can join them: a detection at frame f can only
+    change segments of earlier detections closer than max(max_gap, pre_pad + post_pad) frames. Once the
+    scan moved past that distance, buffered detections are closed into the exact segments get_segments
+    would return for the whole video.
+    """
+
+    def __init__(
+            self,
+            pre_pad: int,
+            post_pad: int,
+            video_length: int,
+            max_gap: int = 0,
+            min_hits: int = 1,
+            min_duration: int = 0,
+            max_duration: int | None = None
+        ):
+        self.segment_options = {
+            "pre_pad": pre_pad,
+            "post_pad": post_pad,
+            "video_length": video_length,
+            "max_gap": max_gap,
+            "min_hits": min_hits,
+            "min_duration": min_duration,
+            "max_duration": max_duration,
+        }
+        self.reach = max(max_gap, pre_pad + post_pad)
+        self.pre_pad = pre_pad
+        self.position = 0
+        self.hits = []
+        # index of the last buffered detection too far from its predecessor to share a segment
+        self._break = 0
+
+    @property
+    def horizon(self) -> int:
+        """Lowest frame where a segment not returned yet can start"""
+        return (self.hits[0] if self.hits else self.position) - self.pre_pad
+
+    def push(self, frame_index: int) -> None:
+        """Add a detection, frame indices must be pushed in increasing order"""
+        if self.hits and frame_index - self.hits[-1] > self.reach:
+            self._break = len(self.hits)
+        self.hits.append(frame_index)
+        self.position = max(self.position, frame_index)
+
+    def advance(self, position: int) -> np.ndarray:
+        """
+        Declare that every frame before position was scanned, and return segments that are now closed
+
+        Args:
+            position (int): index of the next frame to scan
+
+        Returns:
+            np.ndarray: (K, 2) array of closed (start, end) segments
+        """
+        self.position = max(self.position, position)
+        if self.hits and self.position - self.hits[-1] > self.reach:
+            return self._close(len(self.hits))
+        return self._close(self._break)
+
+    def flush(self) -> np.ndarray:
+        """Return segments of all buffered detections, at the end of the scan"""
+        return self._close(len(self.hits))
+
+    def _close(self, count: int) -> np.ndarray:
+        """Return segments of the first count buffered detections and drop them from the buffer"""
+        if count == 0:
+            return np.empty((0, 2), dtype=np.int64)
+        closed_hits, self.hits = self.hits[:count], self.hits[count:]
+        self._break = 0
+        return get_segments(np.asarray(closed_hits, dtype=np.int64), **self.segment_options)
+
+
 def merge_overlapping_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
     """
     Merges a list of overlapping or contiguous frame ranges into a list of non-overlapping ranges.
@@ -39,7 +248,7 @@ def merge_overlapping_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, i
 
     Args:
         ranges (list[tuple[int, int]]): A list of tuples where each tuple contains two integers
-        representing the start and end of a range. The ranges must be sorted by the start value.
+        representing the start and end of a range.
 
     Returns:
         list[tuple[int, int]]: A list of tuples representing the merged non-overlapping ranges.
@@ -49,24 +258,10 @@ def merge_overlapping_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, i
         [(1, 6), (8, 12)]
     
     Notes:
-        - The input `ranges` must be sorted by the first element of the tuple (the start of the range).
         - If the input list is empty, an empty list will be returned.
         - Ranges are merged when one range's start is less than or equal to the previous range's end.
     """
-    merged_ranges = []
-    current_start, current_end = ranges[0]
-
-    for start, end in ranges[1:]:
-        if start <= current_end:  # Overlap
-            current_end = max(current_end, end)
-        else:
-            merged_ranges.append((current_start, current_end))
-            current_start, current_end = start, end
-
-    # Append the last merged range
-    merged_ranges.append((current_start, current_end))
-    
-    return merged_ranges
+    return [(start, end) for start, end in merge_segments(ranges).tolist()]
 
 
 def validate_encodings_source(images_dir: Path, encodings_file: Path):
@@ -75,8 +270,11 @@ def validate_encodings_source(images_dir: Path, encodings_file: Path):
             logger.critical(f"Images folder {images_dir} not found")
             return
     elif encodings_file:
-        if not has_right_extension(encodings_file, ext=".npy"):
-            logger.critical(f"Encodings file must be .npy - found: {encodings_file}")
+        if Path(encodings_file).is_dir():
+            if not any(Path(encodings_file).glob("*.npy")):
+                logger.critical(f"Encodings folder {encodings_file} contains no .npy file")
+        elif not (has_right_extension(encodings_file, ext=".npy") or has_right_extension(encodings_file, ext=".gallery")):
+            logger.critical(f"Encodings file must be .gallery or .npy - found: {encodings_file}")
     else:
         logger.fatal("No source of encodings provided")
         raise click.UsageError("You must provide either --images-dir or --encodings-file.")
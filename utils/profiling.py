@@ -0,0 +1,156 @@
+"""Profiling hooks: deterministic profiler, stack sampler and named timers around hot functions"""
+
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger()
+
+# name -> [total seconds, calls], filled only while timers are enabled
+_timers: dict[str, list] = {}
+_timers_enabled = False
+
+
+def timed(func):
+    """
+    Decorator that accumulates calls and time spent in func while timers are enabled.
+    When timers are disabled, the only cost is one extra call and a flag check.
+    """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _timers_enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer = _timers.setdefault(name, [0.0, 0])
+            timer[0] += time.perf_counter() - start
+            timer[1] += 1
+
+    return wrapper
+
+
+def enable_timers(enabled: bool = True) -> None:
+    """Start or stop accumulating time in functions decorated with timed"""
+    global _timers_enabled
+    _timers_enabled = enabled
+
+
+def timers_enabled() -> bool:
+    """Returns whether timed functions currently accumulate time"""
+    return _timers_enabled
+
+
+def run_timed(func, *args, **kwargs) -> tuple:
+    """
+    Run func with timers enabled, in a worker process whose timers the parent cannot see
+
+    Returns:
+        tuple: result of func, {name: [total seconds, calls]} of timed functions called by func
+    """
+    global _timers
+    saved_timers, saved_enabled = _timers, _timers_enabled
+    _timers = {}
+    enable_timers()
+    try:
+        return func(*args, **kwargs), _timers
+    finally:
+        _timers = saved_timers
+        enable_timers(saved_enabled)
+
+
+def add_timers(timers: dict[str, list]) -> None:
+    """Add timers measured elsewhere (see run_timed) to the timers of this process"""
+    for name, (total, calls) in timers.items():
+        timer = _timers.setdefault(name, [0.0, 0])
+        timer[0] += total
+        timer[1] += calls
+
+
+def timers_report() -> str:
+    """Returns a table of time spent in timed functions, slowest first"""
+    lines = [f"{'function':<40} {'calls':>10} {'total s':>10} {'per call ms':>12}"]
+    for name, (total, calls) in sorted(_timers.items(), key=lambda item: item[1][0], reverse=True):
+        lines.append(f"{name:<40} {calls:>10} {total:>10.3f} {1000 * total / calls:>12.3f}")
+    return "\n".join(lines)
+
+
+class StackSampler(threading.Thread):
+    """Thread that samples the stack of another thread at a fixed interval, for flame graphs"""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        super().__init__(name="StackSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the thread to end"""
+        self._stopped.set()
+        self.join()
+
+    def write_collapsed(self, output_path: Path) -> None:
+        """Save samples in collapsed stack format, one 'frame;frame;frame count' line per stack"""
+        with open(output_path, "wt", encoding="UTF8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler():
+    """Run cProfile, a stack sampler and named timers on the calling thread"""
+
+    def __init__(self, sampling_interval: float = 0.005):
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), interval=sampling_interval)
+
+    def start(self) -> None:
+        """Start profiling"""
+        enable_timers()
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self, output_dir: Path) -> None:
+        """
+        Stop profiling and save results to output_dir:
+
+            - profile_{timestamp}.pstats: deterministic profile, readable with pstats or snakeviz
+            - profile_{timestamp}.collapsed: sampled stacks, readable with flamegraph.pl or speedscope
+            - profile_{timestamp}_timers.txt: time spent in timed functions
+
+        Args:
+            output_dir (Path): directory where to save profiling results
+        """
+        self.profile.disable()
+        self.sampler.stop()
+        enable_timers(False)
+
+        timestamp = datetime.today().strftime("%Y%m%d_%H%M%S")
+        output_path = Path(output_dir) / f"profile_{timestamp}"
+        self.profile.dump_stats(output_path.with_suffix(".pstats"))
+        self.sampler.write_collapsed(output_path.with_suffix(".collapsed"))
+        report = timers_report()
+        with open(f"{output_path}_timers.txt", "wt", encoding="UTF8") as f:
+            f.write(report)
+        logger.info(f"Saved profile to {output_path}.*\n{report}")